@@ -0,0 +1,111 @@
+from argparse import ArgumentParser
+from multiprocessing import cpu_count
+import os
+import sys
+import ujson as json
+from common import log, MeaningTable, ordered_map, prediction_json
+
+
+DEFAULT_MODELS = {
+    'neural': 'neural_w_lessons2.model',
+    'collab': 'collab.model',
+    'glovec': 'glove.6B.50d.txt',
+}
+DEFAULT_NEURAL_WEIGHTS = 'neural_w_lessons2.npz'
+
+# set in the parent before the pool forks, so workers share the loaded model
+predictor = None
+
+
+def load_method(name, model=None, table=None, neural_weights=None):
+    """Loads a predictor by method name as the server does.
+
+    A legacy neural model uses exported `neural_weights` when the file
+    exists and runs in Keras otherwise.
+    """
+    model = model or DEFAULT_MODELS[name]
+    table = table or MeaningTable()
+    if name == 'neural':
+        from neural import NeuralPredict
+        if os.path.isdir(model):
+            neural_weights = None
+        elif neural_weights and not os.path.exists(neural_weights):
+            log.info('No exported weights %s, loading Keras model' % neural_weights)
+            neural_weights = None
+        return NeuralPredict.load(model, table, neural_weights)
+    if name == 'collab':
+        from collab import CollabPredict
+        return CollabPredict.load(model, table)
+    from glovec import GlovePredict
+    return GlovePredict(model, table)
+
+
+def fork_safe_workers(predictor, workers):
+    """Returns `workers`, or 1 for a neural model running in Keras, which is not fork safe."""
+    from neural import NeuralPredict, NumpyModel
+    if workers > 1 and isinstance(predictor, NeuralPredict) and not isinstance(predictor.model, NumpyModel):
+        log.warning('Neural model runs in Keras, which is not fork safe; predicting in one process. '
+                    'Export NumPy weights with neural.py -x to use more workers')
+        return 1
+    return workers
+
+
+def predict_lines(lines, count):
+    seeds_arr = [[x.encode('utf-8') for x in json.loads(line)] for line in lines]
+    results = predictor.predict_batch(seeds_arr, count)
+    return [json.dumps({'seeds': seeds, 'words': prediction_json(words)}) for seeds, words in zip(seeds_arr, results)]
+
+
+def read_chunks(f, chunk_size):
+    chunk = []
+    for line in f:
+        if not line.strip():
+            continue
+        chunk.append(line)
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def predict_file(f, out, count, workers, chunk_size):
+    """Writes a JSON line of predictions for every seed list line of `f`, in input order."""
+    total = 0
+    for lines in ordered_map(predict_lines, ((chunk, count) for chunk in read_chunks(f, chunk_size)), workers):
+        for line in lines:
+            out.write(line + '\n')
+        total += len(lines)
+    log.info('Total %s seed lists done.' % total)
+
+
+def main(args):
+    global predictor
+    predictor = load_method(args.method, args.model, neural_weights=args.neural_weights)
+    workers = fork_safe_workers(predictor, args.workers)
+    f = open(args.input, 'r') if args.input != '-' else sys.stdin
+    out = open(args.output, 'w') if args.output != '-' else sys.stdout
+    try:
+        predict_file(f, out, args.count, workers, args.chunk_size)
+    finally:
+        out.flush()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Predicts words for a file of JSON seed lists, one per line')
+    parser.add_argument('-m', '--method', choices=sorted(DEFAULT_MODELS), required=True)
+    parser.add_argument('-M', '--model', metavar='FILE', help='Model file (default: the one the server loads)')
+    parser.add_argument('-i', '--input', default='-', metavar='FILE')
+    parser.add_argument('-o', '--output', default='-', metavar='FILE')
+    parser.add_argument('-n', '--count', type=int, default=15)
+    parser.add_argument('-w', '--workers', type=int, default=cpu_count())
+    parser.add_argument('-c', '--chunk-size', type=int, default=256, help='Seed lists predicted as one batch')
+    parser.add_argument(
+        '--neural-weights',
+        default=DEFAULT_NEURAL_WEIGHTS,
+        metavar='FILE',
+        help='Weights exported by neural.py --export for a legacy JSON model, used when present'
+    )
+
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,89 @@
+from argparse import ArgumentParser
+import numpy as np
+import time
+from common import int_list, log, MeaningTable
+from glovec import BACKENDS, make_backend, read_vectors
+
+
+def recall(found, expected):
+    hits = [len(set(x) & set(y)) for x, y in zip(found, expected)]
+    return float(sum(hits)) / sum(len(y) for y in expected)
+
+
+def run_queries(backend, queries, k):
+    """Queries one vector at a time, like the server does, and returns (ids, latencies in ms)."""
+    found = []
+    latencies = []
+    for query in queries:
+        start = time.time()
+        ids, _ = backend.query(query[np.newaxis], k)[0]
+        latencies.append((time.time() - start) * 1000)
+        found.append(ids)
+    return found, np.array(latencies)
+
+
+def report(name, build_time, found, expected, latencies):
+    print '%-32s build %8.1fs  recall@%d %.4f  p50 %7.2fms  p99 %7.2fms  qps %8.1f' % (
+        name,
+        build_time,
+        len(expected[0]),
+        recall(found, expected),
+        np.percentile(latencies, 50),
+        np.percentile(latencies, 99),
+        1000 * len(latencies) / latencies.sum()
+    )
+
+
+def build(name, params, vectors):
+    backend = make_backend(name, params)
+    start = time.time()
+    backend.build(vectors)
+    return backend, time.time() - start
+
+
+def main(args):
+    _, vectors = read_vectors(args.glovec, MeaningTable())
+    rng = np.random.RandomState(args.seed)
+    queries = vectors[rng.choice(len(vectors), min(args.queries, len(vectors)), replace=False)]
+    log.info('%s vectors of %s dimensions, %s queries' % (vectors.shape[0], vectors.shape[1], len(queries)))
+
+    exact, build_time = build('exact', [], vectors)
+    expected, latencies = run_queries(exact, queries, args.k)
+    report('exact', build_time, expected, expected, latencies)
+
+    if 'int8' in args.backends:
+        for rerank in args.rerank:
+            backend, build_time = build('int8', ['rerank=%s' % rerank], vectors)
+            found, latencies = run_queries(backend, queries, args.k)
+            report('int8 rerank=%s' % rerank, build_time, found, expected, latencies)
+
+    if 'hnsw' in args.backends:
+        for M in args.M:
+            params = ['M=%s' % M, 'efConstruction=%s' % args.ef_construction, 'num_threads=1']
+            backend, build_time = build('hnsw', params, vectors)
+            for ef_search in args.ef_search:
+                backend.set_ef_search(ef_search)
+                found, latencies = run_queries(backend, queries, args.k)
+                report('hnsw M=%s efSearch=%s' % (M, ef_search), build_time, found, expected, latencies)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Recall@k against exact search and latency of glovec index backends')
+    parser.add_argument('-g', '--glovec', metavar='FILE', default='glove.6B.50d.txt')
+    parser.add_argument('-k', type=int, default=30)
+    parser.add_argument('-n', '--queries', type=int, default=1000)
+    parser.add_argument('-s', '--seed', type=int, default=100500)
+    parser.add_argument(
+        '-b',
+        '--backends',
+        type=lambda x: x.split(','),
+        default=sorted(BACKENDS),
+        help='Comma separated backends; exact always runs as the baseline'
+    )
+    parser.add_argument('--M', type=int_list, default=[16], help='Comma separated HNSW M values')
+    parser.add_argument('--ef-construction', type=int, default=200)
+    parser.add_argument('--ef-search', type=int_list, default=[10, 30, 50, 100, 200, 400])
+    parser.add_argument('--rerank', type=int_list, default=[1, 4, 16], help='Comma separated int8 rerank factors')
+
+    args = parser.parse_args()
+    main(args)
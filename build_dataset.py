@@ -0,0 +1,18 @@
+from argparse import ArgumentParser
+from common import AddedWordDataset, log, read_added_words
+
+
+def main(args):
+    log.info('Reading %s...' % args.input)
+    dataset = AddedWordDataset.build(read_added_words(args.input))
+    log.info('Saving dataset to %s...' % args.output)
+    dataset.save(args.output)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser()
+    parser.add_argument('-i', '--input', default='user_words_train.json', metavar='FILE')
+    parser.add_argument('-o', '--output', default='user_words_train.data', metavar='DIR')
+
+    args = parser.parse_args()
+    main(args)
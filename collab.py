@@ -1,11 +1,29 @@
 from argparse import ArgumentParser
 from collections import defaultdict
 import numpy as np
-from common import AddedWord, log
+import os
+from scipy import sparse
+import sys
+from common import (
+    AddedWordDataset, Meaning, MeaningTable, StringTable, group_by_user, log, read_manifest, read_range,
+    read_user_groups, replace_dir, user_shards, write_manifest
+)
+from multiprocessing import Pool, cpu_count
 import cPickle
 
 
+MODEL_FORMAT = 'collab'
+MODEL_VERSION = 1
+COUNTS_FORMAT = 'collab_counts'
+COUNTS_VERSION = 1
+SHARDS_PER_WORKER = 4
+MAX_USER_WORDS = 100
+MIN_SCORED_HYPO_COUNT = 10
+MIN_SCORED_PAIR_COUNT = 5
+
+
 class Stats(object):
+    """Per-word statistics of the legacy object-graph model (kept to read old pickles)."""
     __slots__ = ['count', 'meanings', 'word']
 
     def __getstate__(self):
@@ -26,139 +44,710 @@ class Stats(object):
         self.meanings[meaning] += 1
 
 
+def resize_csr(matrix, shape):
+    """Grows CSR matrix to the given shape without copying its data."""
+    extra_rows = shape[0] - matrix.shape[0]
+    indptr = matrix.indptr
+    if extra_rows > 0:
+        indptr = np.concatenate([indptr, np.repeat(indptr[-1], extra_rows)])
+    return sparse.csr_matrix((matrix.data, matrix.indices, indptr), shape=shape)
+
+
+def find_pickled_class(module, name):
+    """Resolves classes of old pickles, saved by collab.py run as a script, to this module."""
+    if module == '__main__':
+        module = __name__
+    __import__(module)
+    return getattr(sys.modules[module], name)
+
+
+class UserHistory(object):
+    """First MAX_USER_WORDS counted (word id, meaning col) items of every user.
+
+    Saved users are kept in flat arrays sorted by user id, users changed
+    since are kept in `changed` until `compact` merges them in.
+    """
+    def __init__(self, user_ids=None, indptr=None, word_ids=None, cols=None):
+        self.user_ids = np.zeros(0, dtype=np.int64) if user_ids is None else user_ids
+        self.indptr = np.zeros(1, dtype=np.int64) if indptr is None else indptr
+        self.word_ids = np.zeros(0, dtype=np.int32) if word_ids is None else word_ids
+        self.cols = np.zeros(0, dtype=np.int32) if cols is None else cols
+        self.changed = {}
+
+    def __len__(self):
+        return len(self.user_ids) + len([x for x in self.changed if not self.saved(x)])
+
+    def saved(self, user_id):
+        index = np.searchsorted(self.user_ids, user_id)
+        return index if index < len(self.user_ids) and self.user_ids[index] == user_id else None
+
+    def get(self, user_id):
+        if user_id in self.changed:
+            return self.changed[user_id]
+        index = self.saved(user_id)
+        if index is None:
+            return self.word_ids[:0], self.cols[:0]
+        start, end = self.indptr[index], self.indptr[index + 1]
+        return self.word_ids[start:end], self.cols[start:end]
+
+    def set(self, user_id, word_ids, cols):
+        self.changed[user_id] = (word_ids, cols)
+        if len(self.changed) > max(100000, len(self.user_ids)):
+            self.compact()
+
+    def compact(self):
+        if not self.changed:
+            return
+        changed_ids = np.array(sorted(self.changed), dtype=np.int64)
+        keep = ~np.in1d(self.user_ids, changed_ids)
+        items = np.repeat(keep, np.diff(self.indptr))
+        merged = UserHistory.from_segments(
+            np.concatenate([self.user_ids[keep], changed_ids]),
+            np.concatenate([np.diff(self.indptr)[keep], [len(self.changed[x][0]) for x in changed_ids]]),
+            np.concatenate([self.word_ids[items]] + [self.changed[x][0] for x in changed_ids]),
+            np.concatenate([self.cols[items]] + [self.changed[x][1] for x in changed_ids])
+        )
+        self.user_ids, self.indptr, self.word_ids, self.cols = merged.user_ids, merged.indptr, merged.word_ids, merged.cols
+        self.changed = {}
+
+    @staticmethod
+    def from_segments(user_ids, lengths, word_ids, cols):
+        """Builds history from consecutive segments of items of distinct users in any order."""
+        lengths = np.asarray(lengths, dtype=np.int64)
+        order = np.argsort(user_ids, kind='mergesort')
+        starts = np.cumsum(lengths) - lengths
+        indptr = np.zeros(len(order) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum(lengths[order])
+        items = np.repeat(starts[order] - indptr[:-1], lengths[order]) + np.arange(indptr[-1])
+        return UserHistory(
+            np.asarray(user_ids, dtype=np.int64)[order],
+            indptr,
+            np.asarray(word_ids, dtype=np.int32)[items],
+            np.asarray(cols, dtype=np.int32)[items]
+        )
+
+    def save(self, dirname):
+        self.compact()
+        for name in ['user_ids', 'indptr', 'word_ids', 'cols']:
+            np.save(os.path.join(dirname, 'history.%s.npy' % name), getattr(self, name))
+
+    @staticmethod
+    def load(dirname, mmap_mode='r'):
+        return UserHistory(*[
+            np.load(os.path.join(dirname, 'history.%s.npy' % name), mmap_mode=mmap_mode)
+            for name in ['user_ids', 'indptr', 'word_ids', 'cols']
+        ])
+
+
+class CooccurrenceCounter(object):
+    """Word x meaning co-occurrence counts over integer ids.
+
+    Pairs of every user are buffered as COO rows/cols and are summed into
+    the CSR count matrix once `flush_size` pairs are collected. With
+    `histories` the counted items of every user are kept, so users may be
+    extended by later updates and are merged by user id.
+    """
+    def __init__(self, flush_size=10000000, histories=None):
+        self.words = []
+        self.word_index = {}
+        self.meaning_ids = []
+        self.meaning_words = []
+        self.meaning_ru = []
+        self.meaning_index = {}
+        self.total_users = 0
+        self.word_counts = np.zeros(0, dtype=np.int32)
+        self.pairs = sparse.csr_matrix((0, 0), dtype=np.int32)
+        self.flush_size = flush_size
+        self._rows = []
+        self._cols = []
+        self._user_words = []
+        self._pending = 0
+        self._pair_indexes = {}
+        self.histories = histories
+
+    def set_vocab(self, words, meaning_ids, meaning_words, meaning_ru):
+        """Adopts an existing id space, e.g. of AddedWordDataset."""
+        self.words = list(words)
+        self.word_index = dict((w, i) for i, w in enumerate(self.words))
+        self.meaning_ids = list(meaning_ids)
+        self.meaning_words = list(meaning_words)
+        self.meaning_ru = list(meaning_ru)
+        self.meaning_index = dict((x, i) for i, x in enumerate(self.meaning_ids))
+
+    def word_id(self, word):
+        index = self.word_index.get(word)
+        if index is None:
+            index = len(self.words)
+            self.words.append(word)
+            self.word_index[word] = index
+        return index
+
+    def meaning_col(self, meaning):
+        col = self.meaning_index.get(meaning.meaning_id)
+        if col is None:
+            col = len(self.meaning_ids)
+            self.meaning_ids.append(meaning.meaning_id)
+            self.meaning_words.append(self.word_id(meaning.en))
+            self.meaning_ru.append(meaning.ru)
+            self.meaning_index[meaning.meaning_id] = col
+        return col
+
+    def pair_index(self, n):
+        """Returns (left, right) positions of all ordered pairs i != j of n items."""
+        if n not in self._pair_indexes:
+            left = np.repeat(np.arange(n, dtype=np.int32), n)
+            right = np.tile(np.arange(n, dtype=np.int32), n)
+            mask = left != right
+            self._pair_indexes[n] = left[mask], right[mask]
+        return self._pair_indexes[n]
+
+    def add_user(self, meanings, user_id=None):
+        meanings = meanings[:MAX_USER_WORDS]
+        word_ids = np.array([self.word_id(x.en) for x in meanings], dtype=np.int32)
+        cols = np.array([self.meaning_col(x) for x in meanings], dtype=np.int32)
+        if self.histories is not None:
+            self.add_user_history(user_id, word_ids, cols)
+        else:
+            self.add_user_ids(word_ids, cols)
+
+    def add_user_history(self, user_id, word_ids, cols):
+        """Appends items to the history of `user_id` and counts what they add."""
+        old_words, old_cols = self.histories.get(user_id)
+        known = len(old_words)
+        if known >= MAX_USER_WORDS:
+            return
+        word_ids = np.concatenate([old_words, word_ids[:MAX_USER_WORDS - known]]).astype(np.int32)
+        cols = np.concatenate([old_cols, cols[:MAX_USER_WORDS - known]]).astype(np.int32)
+        self.histories.set(user_id, word_ids, cols)
+        self.add_user_ids(word_ids, cols, known)
+
+    def add_user_ids(self, word_ids, cols, known=0):
+        """Counts items of a user whose first `known` items were counted before."""
+        if known == 0:
+            self.total_users += 1
+        self._user_words.append(word_ids[known:])
+        if len(word_ids) > 1:
+            left, right = self.pair_index(len(word_ids))
+            if known:
+                new = (left >= known) | (right >= known)
+                left, right = left[new], right[new]
+            self._rows.append(word_ids[left])
+            self._cols.append(cols[right])
+            self._pending += len(left)
+        if self._pending >= self.flush_size:
+            self.flush()
+
+    def flush(self):
+        shape = (len(self.words), len(self.meaning_ids))
+        word_counts = np.zeros(shape[0], dtype=np.int32)
+        word_counts[:len(self.word_counts)] = self.word_counts
+        if self._user_words:
+            word_counts += np.bincount(
+                np.concatenate(self._user_words), minlength=shape[0]
+            ).astype(np.int32)
+        self.word_counts = word_counts
+
+        pairs = resize_csr(self.pairs, shape)
+        if self._rows:
+            rows = np.concatenate(self._rows)
+            cols = np.concatenate(self._cols)
+            batch = sparse.coo_matrix(
+                (np.ones(len(rows), dtype=np.int32), (rows, cols)),
+                shape=shape
+            ).tocsr()
+            pairs = pairs + batch
+        self.pairs = pairs
+
+        self._rows = []
+        self._cols = []
+        self._user_words = []
+        self._pending = 0
+
+    def merge(self, other):
+        """Adds counts of `other` counter, e.g. of another shard, mapping its ids into ours.
+
+        Returns (word_map, col_map) of other ids. User histories are not merged.
+        """
+        self.flush()
+        word_map = np.array([self.word_id(x) for x in other.words], dtype=np.int32)
+        col_map = np.array([
+            self.meaning_col(Meaning(meaning_id, other.words[word], ru))
+            for meaning_id, word, ru in zip(other.meaning_ids, other.meaning_words, other.meaning_ru)
+        ], dtype=np.int32)
+        shape = (len(self.words), len(self.meaning_ids))
+        word_counts = np.zeros(shape[0], dtype=np.int32)
+        word_counts[:len(self.word_counts)] = self.word_counts
+        word_counts[word_map] += other.word_counts
+        self.word_counts = word_counts
+
+        pairs = other.pairs.tocoo()
+        self.pairs = resize_csr(self.pairs, shape) + sparse.csr_matrix(
+            (pairs.data, (word_map[pairs.row], col_map[pairs.col])),
+            shape=shape,
+            dtype=np.int32
+        )
+        self.total_users += other.total_users
+        return word_map, col_map
+
+    def save(self, dirname):
+        """Saves unpruned counts and user histories, see CollabPredict.from_counts."""
+        self.flush()
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        StringTable.from_strings(self.words).save(dirname, 'words')
+        StringTable.from_strings(self.meaning_ru).save(dirname, 'meaning_ru')
+        np.save(os.path.join(dirname, 'meaning_ids.npy'), np.array(self.meaning_ids, dtype=np.int32))
+        np.save(os.path.join(dirname, 'meaning_words.npy'), np.array(self.meaning_words, dtype=np.int32))
+        np.save(os.path.join(dirname, 'word_counts.npy'), self.word_counts)
+        for name in ['data', 'indices', 'indptr']:
+            np.save(os.path.join(dirname, 'pairs.%s.npy' % name), getattr(self.pairs, name))
+        if self.histories is not None:
+            self.histories.save(dirname)
+        write_manifest(dirname, {
+            'format': COUNTS_FORMAT,
+            'version': COUNTS_VERSION,
+            'total_users': self.total_users,
+            'histories': self.histories is not None
+        })
+
+    @staticmethod
+    def load(dirname, mmap_mode='r'):
+        manifest = read_manifest(dirname, COUNTS_FORMAT, COUNTS_VERSION)
+        self = CooccurrenceCounter()
+        self.set_vocab(
+            StringTable.load(dirname, 'words', mmap_mode),
+            np.load(os.path.join(dirname, 'meaning_ids.npy')).tolist(),
+            np.load(os.path.join(dirname, 'meaning_words.npy')).tolist(),
+            StringTable.load(dirname, 'meaning_ru', mmap_mode)
+        )
+        self.total_users = manifest['total_users']
+        self.word_counts = np.load(os.path.join(dirname, 'word_counts.npy'))
+        self.pairs = sparse.csr_matrix(
+            tuple(np.load(os.path.join(dirname, 'pairs.%s.npy' % x), mmap_mode=mmap_mode)
+                  for x in ['data', 'indices', 'indptr']),
+            shape=(len(self.words), len(self.meaning_ids))
+        )
+        if manifest['histories']:
+            self.histories = UserHistory.load(dirname, mmap_mode)
+        return self
+
+
+def count_shard(shard):
+    """Counts users of a (filename, start, end, keep_history) byte range in a worker process."""
+    filename, start, end, keep_history = shard
+    counter = CooccurrenceCounter(histories=UserHistory() if keep_history else None)
+    for user_id, added_words in group_by_user(read_range(filename, start, end, 'search_')):
+        counter.add_user([x.meaning for x in added_words], user_id)
+    counter.flush()
+    if keep_history:
+        counter.histories.compact()
+    counter._pair_indexes = {}
+    return counter
+
+
 class CollabPredict(object):
-    def __init__(self, words_file, min_self_count=5, min_hypo_count=3):
-        self.word_dict = {}
+    def __init__(self, words_file=None, min_self_count=5, min_hypo_count=3, table=None):
+        self.table = table or MeaningTable()
+        self.word_ids = np.zeros(0, dtype=np.int32)
+        self.row_of_word = np.zeros(0, dtype=np.int32)
+        self.word_counts = np.zeros(0, dtype=np.int32)
+        self.meanings = np.zeros(0, dtype=np.int32)
+        self.meaning_words = np.zeros(0, dtype=np.int32)
+        self.pairs = sparse.csr_matrix((0, 0), dtype=np.int32)
+        self.set_scores(sparse.csr_matrix((0, 0)))
         self.total_users = 0
         self.min_self_count = min_self_count
         self.min_hypo_count = min_hypo_count
+        self.counter = None
+        if words_file is None:
+            return
+
+        self.counter = CooccurrenceCounter()
         log.info('Reading input file...')
-        with open(words_file, 'r') as f:
-            self.init_from_file(f)
+        self.init_from_file(words_file)
 
         log.info('Pruning model...')
         self.prune()
 
+    @staticmethod
+    def from_counts(counter, min_self_count=5, min_hypo_count=3, table=None):
+        """Builds a pruned model from `counter`, whose counts are kept intact."""
+        self = CollabPredict(None, min_self_count, min_hypo_count, table)
+        self.counter = counter
+        self.prune()
+        return self
+
     def prune(self):
-        keys_to_delete = []
+        counter = self.counter
+        counter.flush()
+        pairs = counter.pairs.copy()
+        pairs.data[pairs.data < self.min_hypo_count] = 0
+        pairs.eliminate_zeros()
 
-        for key, stat in self.word_dict.iteritems():
-            meanings_to_delete = []
-            if stat.count < self.min_self_count:
-                keys_to_delete.append(key)
-                continue
+        meaning_words = np.array(counter.meaning_words, dtype=np.int32)
+        keep_words = (counter.word_counts >= self.min_self_count) & (np.diff(pairs.indptr) > 0)
+        pairs = pairs[np.flatnonzero(keep_words)]
 
-            for meaning, count in stat.meanings.iteritems():
-                if count < self.min_hypo_count:
-                    meanings_to_delete.append(meaning)
-            for meaning in meanings_to_delete:
-                del stat.meanings[meaning]
-            if len(stat.meanings) < 1:
-                keys_to_delete.append(key)
-                continue
+        keep_meanings = keep_words[meaning_words] & (
+            np.bincount(pairs.indices, minlength=len(meaning_words)) > 0
+        )
+        pairs = pairs[:, np.flatnonzero(keep_meanings)]
+
+        word_map = np.cumsum(keep_words, dtype=np.int32) - 1
+        self.set_vocab(
+            [w for w, keep in zip(counter.words, keep_words) if keep],
+            np.array(counter.meaning_ids, dtype=np.int32)[keep_meanings],
+            word_map[meaning_words[keep_meanings]],
+            [ru for ru, keep in zip(counter.meaning_ru, keep_meanings) if keep]
+        )
+        self.word_counts = counter.word_counts[keep_words]
+        self.pairs = sparse.csr_matrix(pairs, dtype=np.int32)
+        self.total_users = counter.total_users
+        self.counter = None
+        log.info('Total %s words and %s meanings, %s pairs' % (
+            len(self.word_ids), len(self.meanings), self.pairs.nnz))
+        self.build_scores()
+
+    def set_vocab(self, words, meaning_ids, meaning_words, meaning_ru):
+        """Registers rows (words) and columns (meanings) in the meaning table."""
+        self.word_ids = np.array([self.table.add_word(x) for x in words], dtype=np.int32)
+        self.meanings = np.array([
+            self.table.add_meaning(int(meaning_id), words[word], ru)
+            for meaning_id, word, ru in zip(meaning_ids, meaning_words, meaning_ru)
+        ], dtype=np.int32)
+        self.meaning_words = np.asarray(meaning_words, dtype=np.int32)
+        self.row_of_word = self.table.word_mapping(self.word_ids)
+
+    def build_scores(self):
+        """Precomputes word x meaning PMI scores used by predict."""
+        pairs = self.pairs.tocoo()
+        hypo_counts = self.word_counts[self.meaning_words[pairs.col]]
+        mask = (hypo_counts >= MIN_SCORED_HYPO_COUNT) & (pairs.data >= MIN_SCORED_PAIR_COUNT)
+        rows, cols = pairs.row[mask], pairs.col[mask]
+        hypo_counts = hypo_counts[mask]
+        y = hypo_counts * 1.0 / self.total_users
+        cond_y = pairs.data[mask] * 1.0 / self.word_counts[rows]
+        self.set_scores(sparse.csr_matrix(
+            (np.log(cond_y/y) * np.log(hypo_counts), (rows, cols)),
+            shape=self.pairs.shape
+        ))
 
-        for key in keys_to_delete:
-            del self.word_dict[key]
+    def set_scores(self, scores):
+        """Sets scores and their structure (all entries 1) used by predict_batch.
 
-        for key, stat in self.word_dict.iteritems():
-            meanings_to_delete = []
-            for meaning in stat.meanings:
-                if meaning.en not in self.word_dict:
-                    meanings_to_delete.append(meaning)
-            for meaning in meanings_to_delete:
-                del stat.meanings[meaning]
+        The structure shares indices and indptr with `scores`, only its
+        int8 data is allocated, once per model.
+        """
+        self.scores = scores
+        self.score_pattern = sparse.csr_matrix(
+            (np.ones(len(scores.data), dtype=np.int8), scores.indices, scores.indptr),
+            shape=scores.shape,
+            copy=False
+        )
 
     @staticmethod
-    def load(filename):
+    def from_word_dict(word_dict, total_users, min_self_count, min_hypo_count, table=None):
+        """Builds the sparse model from the legacy pruned `Stats` dict."""
+        self = CollabPredict(None, min_self_count, min_hypo_count, table)
+        words = sorted(word_dict)
+        word_index = dict((w, i) for i, w in enumerate(words))
+        meanings = sorted(set(m for stat in word_dict.itervalues() for m in stat.meanings))
+        meaning_index = dict((m.meaning_id, i) for i, m in enumerate(meanings))
+        self.set_vocab(
+            words,
+            [m.meaning_id for m in meanings],
+            [word_index[m.en] for m in meanings],
+            [m.ru for m in meanings]
+        )
+        self.word_counts = np.array([word_dict[w].count for w in words], dtype=np.int32)
+
+        rows, cols, data = [], [], []
+        for row, word in enumerate(words):
+            for meaning, count in word_dict[word].meanings.iteritems():
+                rows.append(row)
+                cols.append(meaning_index[meaning.meaning_id])
+                data.append(count)
+        self.pairs = sparse.coo_matrix(
+            (np.array(data, dtype=np.int32), (rows, cols)),
+            shape=(len(words), len(meanings))
+        ).tocsr()
+        self.total_users = total_users
+        self.build_scores()
+        return self
+
+    @staticmethod
+    def load(filename, table=None, mmap_mode='r'):
+        if not os.path.isdir(filename):
+            return CollabPredict.load_pickle(filename, table)
+
+        manifest = read_manifest(filename, MODEL_FORMAT, MODEL_VERSION)
+        self = CollabPredict(None, manifest['min_self_count'], manifest['min_hypo_count'], table)
+        self.total_users = manifest['total_users']
+
+        def array(name):
+            return np.load(os.path.join(filename, name + '.npy'), mmap_mode=mmap_mode)
+
+        def csr(name, shape):
+            return sparse.csr_matrix(
+                (array(name + '.data'), array(name + '.indices'), array(name + '.indptr')),
+                shape=shape
+            )
+
+        self.set_vocab(
+            StringTable.load(filename, 'words', mmap_mode),
+            array('meaning_ids'),
+            array('meaning_words'),
+            StringTable.load(filename, 'meaning_ru', mmap_mode)
+        )
+        self.word_counts = array('word_counts')
+        shape = (len(self.word_ids), len(self.meanings))
+        self.pairs = csr('pairs', shape)
+        self.set_scores(csr('scores', shape))
+        return self
+
+    @staticmethod
+    def load_pickle(filename, table=None):
+        """Loads and converts a model pickled by older versions."""
+        log.info('Converting pickled collab model %s...' % filename)
         with open(filename, 'rb') as file:
-            return cPickle.load(file)
+            unpickler = cPickle.Unpickler(file)
+            unpickler.find_global = find_pickled_class
+            model = unpickler.load()
+        return CollabPredict.from_word_dict(
+            model.word_dict,
+            model.total_users,
+            model.min_self_count,
+            model.min_hypo_count,
+            table
+        )
 
     def save(self, filename):
-        with open(filename, 'wb') as file:
-            cPickle.dump(self, file, -1)
-
-    def init_from_file(self, file):
-        prev_user = None
-        meanings = []
-
-        for i, line in enumerate(file):
-            if (i + 1) % 100000 == 0:
-                log.info('Total %s lines done.' % (i + 1))
-            parsed = AddedWord.parse(line)
-            if not parsed or not parsed.source.startswith('search_'):
-                continue
-            meaning = parsed.meaning
-            if prev_user is None:
-                meanings = [meaning]
-                prev_user = parsed.user_id
-                continue
+        if not os.path.isdir(filename):
+            os.makedirs(filename)
+
+        def save_array(name, array):
+            np.save(os.path.join(filename, name + '.npy'), array)
+
+        def save_csr(name, matrix):
+            save_array(name + '.data', matrix.data)
+            save_array(name + '.indices', matrix.indices)
+            save_array(name + '.indptr', matrix.indptr)
 
-            if parsed.user_id != prev_user:
-                self.append_word_pairs(meanings)
-                prev_user = parsed.user_id
-                meanings = []
-            meanings.append(meaning)
+        table = self.table
+        StringTable.from_strings([table.words[x] for x in self.word_ids]).save(filename, 'words')
+        save_array('word_counts', self.word_counts)
+        save_array('meaning_ids', np.array([table.meaning_ids[x] for x in self.meanings], dtype=np.int32))
+        save_array('meaning_words', self.meaning_words)
+        StringTable.from_strings([table.ru(x) for x in self.meanings]).save(filename, 'meaning_ru')
+        save_csr('pairs', self.pairs)
+        save_csr('scores', self.scores)
+        write_manifest(filename, {
+            'format': MODEL_FORMAT,
+            'version': MODEL_VERSION,
+            'total_users': self.total_users,
+            'min_self_count': self.min_self_count,
+            'min_hypo_count': self.min_hypo_count
+        })
 
-        if len(meanings) > 0:
-            self.append_word_pairs(meanings)
+    def init_from_file(self, filename, workers=None):
+        if AddedWordDataset.is_dataset(filename):
+            self.init_from_dataset(AddedWordDataset.load(filename))
+            return
+        workers = workers or cpu_count()
+        if workers > 1 and self.counter.total_users == 0:
+            self.init_from_shards(filename, workers)
+            return
+        for user_id, added_words in read_user_groups(filename, 'search_', workers):
+            self.append_word_pairs([x.meaning for x in added_words], user_id)
 
-    def append_word_pairs(self, meanings):
-        self.total_users += 1
+    def init_from_shards(self, filename, workers):
+        """Counts user aligned byte ranges of the file in `workers` processes and sums the counts.
 
-        meanings = meanings[:100]
+        Shards are merged in file order, so ids and counts are the same as
+        of a sequential pass.
+        """
+        counter = self.counter
+        keep_history = counter.histories is not None
+        shards = [
+            (filename, start, end, keep_history)
+            for start, end in user_shards(filename, workers * SHARDS_PER_WORKER)
+        ]
+        log.info('Counting %s shards in %s processes...' % (len(shards), workers))
+        histories = []
+        pool = Pool(workers)
+        try:
+            for shard in pool.imap(count_shard, shards):
+                word_map, col_map = counter.merge(shard)
+                if keep_history:
+                    history = shard.histories
+                    histories.append((
+                        history.user_ids,
+                        np.diff(history.indptr),
+                        word_map[history.word_ids],
+                        col_map[history.cols]
+                    ))
+        finally:
+            pool.terminate()
+        if keep_history and histories:
+            counter.histories = UserHistory.from_segments(*[np.concatenate(x) for x in zip(*histories)])
+            user_ids = counter.histories.user_ids
+            if np.any(user_ids[1:] == user_ids[:-1]):
+                raise ValueError('Lines of a user are split in %s, sort it by user or use one worker' % filename)
 
-        for meaning in meanings:
-            if meaning.en in self.word_dict:
-                stat = self.word_dict[meaning.en]
-                stat.count += 1
+    def init_from_dataset(self, dataset):
+        counter = self.counter
+        if not counter.words:
+            counter.set_vocab(
+                dataset.words,
+                dataset.table_meaning_ids.tolist(),
+                dataset.table_word_ids.tolist(),
+                dataset.table_ru
+            )
+            word_map = col_map = None
+        else:
+            # counts already have their own ids, map dataset ids into them
+            words = list(dataset.words)
+            word_map = np.array([counter.word_id(x) for x in words], dtype=np.int32)
+            col_map = np.array([
+                counter.meaning_col(Meaning(int(meaning_id), words[word_id], ru))
+                for meaning_id, word_id, ru in zip(dataset.table_meaning_ids, dataset.table_word_ids, dataset.table_ru)
+            ], dtype=np.int32)
+        for user_id, rows in dataset.iter_users('search_'):
+            rows = rows[:MAX_USER_WORDS]
+            word_ids = dataset.word_ids[rows]
+            cols = dataset.meaning_rows(dataset.meaning_ids[rows]).astype(np.int32)
+            if word_map is not None:
+                word_ids, cols = word_map[word_ids], col_map[cols]
+            if counter.histories is not None:
+                counter.add_user_history(user_id, word_ids, cols)
             else:
-                stat = Stats(meaning.en)
-                self.word_dict[meaning.en] = stat
+                counter.add_user_ids(word_ids, cols)
 
-        for i in xrange(len(meanings)):
-            meaning1 = meanings[i]
-            for k in xrange(i + 1, len(meanings)):
-                assert k > i
-                meaning2 = meanings[k]
-                self.word_dict[meaning1.en].add(meaning2)
-                self.word_dict[meaning2.en].add(meaning1)
+    def append_word_pairs(self, meanings, user_id=None):
+        self.counter.add_user(meanings, user_id)
+
+    def top_meanings(self, rows, cols, totals, max_hypos):
+        """Ranks touched `cols` with `totals` scores, skipping meanings of seed `rows`."""
+        keep = ~np.in1d(self.meaning_words[cols], rows)
+        cols, totals = cols[keep], totals[keep]
+        if len(cols) > max_hypos:
+            best = np.argpartition(-totals, max_hypos - 1)[:max_hypos]
+            cols, totals = cols[best], totals[best]
+        order = np.argsort(-totals, kind='mergesort')
+        return [{'word': self.table.meaning(self.meanings[col]), 'score': float(totals[i])} for i, col in zip(order, cols[order])]
 
     def predict(self, seed, max_hypos):
-        scores = defaultdict(float)
-        for word in seed:
-            if word not in self.word_dict:
-                continue
-            stat = self.word_dict[word]
-            for hypo in stat.meanings:
-                hypo_stat = self.word_dict[hypo.en]
-                if hypo_stat.count < 10 or stat.meanings[hypo] < 5:
-                    continue
-                y = hypo_stat.count * 1.0 / self.total_users
-                cond_y = stat.meanings[hypo] * 1.0 / stat.count
-                score = np.log(cond_y/y) * np.log(hypo_stat.count)
-                scores[hypo] += score
+        rows = self.table.lookup(seed, self.row_of_word)
+        rows = rows[rows >= 0]
+        max_hypos = int(max_hypos)
+        if len(rows) < 1 or max_hypos < 1:
+            return []
+
+        # slice rows by hand, scipy row indexing drops scores that are exactly 0
+        starts, ends = self.scores.indptr[rows], self.scores.indptr[rows + 1]
+        lengths = ends - starts
+        items = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+        indices = self.scores.indices[items]
+        totals = np.bincount(
+            indices,
+            weights=self.scores.data[items],
+            minlength=self.scores.shape[1]
+        )
+        cols = np.unique(indices)
+        return self.top_meanings(rows, cols, totals[cols], max_hypos)
 
+    def predict_batch(self, seeds_arr, max_hypos):
+        """Predicts many seed lists with two sparse products of a seed indicator matrix.
+
+        One product sums the scores, the other with `score_pattern`
+        finds the touched meanings, as sums that happen to be 0 are dropped
+        from the first one.
+        """
         max_hypos = int(max_hypos)
+        seed_rows = [self.table.lookup(seeds, self.row_of_word) for seeds in seeds_arr]
+        seed_rows = [x[x >= 0] for x in seed_rows]
+        indptr = np.zeros(len(seed_rows) + 1, dtype=np.int64)
+        indptr[1:] = np.cumsum([len(x) for x in seed_rows])
+        indices = np.concatenate(seed_rows + [np.zeros(0, dtype=np.int32)])
+        seeds = sparse.csr_matrix(
+            (np.ones(len(indices)), indices, indptr),
+            shape=(len(seed_rows), self.scores.shape[0])
+        )
+        totals = seeds.dot(self.scores)
+        totals.sort_indices()
+        touched = seeds.dot(self.score_pattern)
+        touched.sort_indices()
+
         res = []
-        for meaning, score in sorted(scores.items(), key=lambda (w, s): s, reverse=True):
-            if meaning.en in seed:
+        for i, rows in enumerate(seed_rows):
+            if len(rows) < 1 or max_hypos < 1:
+                res.append([])
                 continue
-            if len(res) >= max_hypos:
-                break
-            res.append({'word': meaning, 'score': score})
+            cols = touched.indices[touched.indptr[i]:touched.indptr[i + 1]]
+            total_cols = totals.indices[totals.indptr[i]:totals.indptr[i + 1]]
+            total_data = totals.data[totals.indptr[i]:totals.indptr[i + 1]]
+            pos = np.minimum(np.searchsorted(total_cols, cols), max(len(total_cols) - 1, 0))
+            found = total_cols[pos] == cols if len(total_cols) else np.zeros(len(cols), dtype=bool)
+            row_totals = np.zeros(len(cols))
+            row_totals[found] = total_data[pos[found]]
+            res.append(self.top_meanings(rows, cols, row_totals, max_hypos))
         return res
 
 
 def main(args):
-    log.info('Training predict (input: %s)' % args.train)
-    predict = CollabPredict(args.train)
+    if args.convert:
+        log.info('Converting %s to %s...' % (args.convert, args.model))
+        replace_dir(args.model, CollabPredict.load_pickle(args.convert).save)
+        return
+
+    if args.update:
+        log.info('Updating counts %s with %s' % (args.state, args.update))
+        predict = CollabPredict(None)
+        predict.counter = CooccurrenceCounter.load(args.state)
+        if predict.counter.histories is None:
+            raise ValueError('%s has no user histories to update' % args.state)
+        predict.init_from_file(args.update, args.workers)
+    else:
+        log.info('Training predict (input: %s)' % args.train)
+        predict = CollabPredict(None)
+        predict.counter = CooccurrenceCounter(histories=UserHistory() if args.state else None)
+        predict.init_from_file(args.train, args.workers)
+
+    counter = predict.counter
+    if args.state:
+        log.info('Saving counts to %s...' % args.state)
+        replace_dir(args.state, counter.save)
+    log.info('Pruning model...')
+    predict = CollabPredict.from_counts(counter)
     log.info('Saving model to %s...' % args.model)
-    predict.save(args.model)
+    replace_dir(args.model, predict.save)
 
 if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument('-t', '--train', default='user_words_train.json')
     parser.add_argument('-m', '--model', default='collab.model')
+    parser.add_argument('-c', '--convert', metavar='FILE', help='Convert pickled model to the current format')
+    parser.add_argument(
+        '-s',
+        '--state',
+        metavar='DIR',
+        help='Unpruned counts and user histories, saved after training and read by --update'
+    )
+    parser.add_argument(
+        '-u',
+        '--update',
+        metavar='FILE',
+        help='Add new AddedWord lines to --state counts and rebuild the model from them'
+    )
+    parser.add_argument(
+        '-w',
+        '--workers',
+        type=int,
+        default=cpu_count(),
+        help='Processes counting shards of JSON input (default: all cores)'
+    )
     args = parser.parse_args()
+    if args.update and not args.state:
+        parser.error('--update needs --state')
 
     main(args)
@@ -1,5 +1,15 @@
+from array import array
+import calendar
+from collections import deque
 from datetime import datetime
+import itertools as it
 import logging
+from multiprocessing import Pool, cpu_count
+import numpy as np
+import os
+import re
+import shutil
+import threading
 import ujson as json
 
 def init_logging():
@@ -24,6 +34,92 @@ log = init_logging()
 
 
 DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+MANIFEST_FILE = 'manifest.json'
+READ_CHUNK_BYTES = 16 * 1024 * 1024
+
+
+def parse_time(value):
+    """Parses DATE_FORMAT timestamp, much faster than strptime."""
+    return datetime(
+        int(value[0:4]), int(value[5:7]), int(value[8:10]),
+        int(value[11:13]), int(value[14:16]), int(value[17:19])
+    )
+
+
+def write_manifest(dirname, manifest):
+    with open(os.path.join(dirname, MANIFEST_FILE), 'w') as f:
+        f.write(json.dumps(manifest, indent=4))
+
+
+def read_manifest(dirname, format, version):
+    with open(os.path.join(dirname, MANIFEST_FILE), 'r') as f:
+        manifest = json.loads(f.read())
+    if manifest.get('format') != format or manifest.get('version') != version:
+        raise ValueError('%s is not a %s model of version %s' % (dirname, format, version))
+    return manifest
+
+
+def file_stamp(filename):
+    """Size and modification time that tell if a source file changed since a cache was built from it."""
+    stat = os.stat(filename)
+    return {'size': stat.st_size, 'mtime': int(stat.st_mtime)}
+
+
+def top_k(scores, k):
+    """Returns indexes of the k largest scores of every row, best first."""
+    k = min(k, scores.shape[1])
+    if k < 1:
+        return np.zeros((len(scores), 0), dtype=np.int64)
+    part = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    rows = np.arange(len(scores))[:, np.newaxis]
+    order = np.argsort(-scores[rows, part], axis=1, kind='mergesort')
+    return part[rows, order]
+
+
+def int_list(value):
+    """Parses a comma separated list of ints, for argparse `type`."""
+    return [int(x) for x in value.split(',')]
+
+
+class StringTable(object):
+    """Immutable list of strings packed into one byte array.
+
+    String i is data[offsets[i]:offsets[i + 1]]; both arrays are stored
+    as .npy files and may be memory-mapped on load.
+    """
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+
+    @staticmethod
+    def from_strings(strings):
+        offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(x) for x in strings])
+        data = np.fromstring(''.join(strings), dtype=np.uint8)
+        return StringTable(offsets, data)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index):
+        return self.data[self.offsets[index]:self.offsets[index + 1]].tostring()
+
+    def __iter__(self):
+        data = self.data.tostring()
+        offsets = self.offsets.tolist()
+        for i in xrange(len(offsets) - 1):
+            yield data[offsets[i]:offsets[i + 1]]
+
+    def save(self, dirname, name):
+        np.save(os.path.join(dirname, name + '.offsets.npy'), self.offsets)
+        np.save(os.path.join(dirname, name + '.data.npy'), self.data)
+
+    @staticmethod
+    def load(dirname, name, mmap_mode='r'):
+        return StringTable(
+            np.load(os.path.join(dirname, name + '.offsets.npy'), mmap_mode=mmap_mode),
+            np.load(os.path.join(dirname, name + '.data.npy'), mmap_mode=mmap_mode)
+        )
 
 
 class Meaning(object):
@@ -66,13 +162,110 @@ class Meaning(object):
         return self.meaning_id < other.meaning_id
 
 
+def prediction_json(predictions):
+    """Converts predict() results to the JSON objects served to clients."""
+    return [
+        {
+            'meaning_id': x['word'].meaning_id,
+            'en': x['word'].en,
+            'ru': x['word'].ru,
+            'score': x['score']
+        } for x in predictions
+    ]
+
+
+class MeaningTable(object):
+    """Interned en words and meanings shared by the models of one process.
+
+    Models refer to words by word id (position in `words`) and to
+    meanings by meaning index (position in the meaning arrays, not the
+    Skyeng meaning id) and keep only integer arrays themselves. Every en
+    word is stored once, as one str shared by `words` and `word_index`;
+    ru translations are never looked up and are packed into one buffer.
+    Adding is thread-safe, so models may be loaded into one table at once.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.words = []
+        self.word_index = {}
+        self.meaning_ids = array('i')
+        self.meaning_words = array('i')
+        self.ru_offsets = array('l', [0])
+        self.ru_data = bytearray()
+        self.meaning_index = {}
+
+    def word_count(self):
+        return len(self.words)
+
+    def meaning_count(self):
+        return len(self.meaning_ids)
+
+    def add_word(self, word):
+        word_id = self.word_index.get(word)
+        if word_id is None:
+            with self.lock:
+                word_id = self.word_index.get(word)
+                if word_id is None:
+                    word_id = len(self.words)
+                    word = intern(word)
+                    self.words.append(word)
+                    self.word_index[word] = word_id
+        return word_id
+
+    def add_meaning(self, meaning_id, en, ru):
+        index = self.meaning_index.get(meaning_id)
+        if index is None:
+            word_id = self.add_word(en)
+            with self.lock:
+                index = self.meaning_index.get(meaning_id)
+                if index is None:
+                    index = len(self.meaning_ids)
+                    self.meaning_ids.append(meaning_id)
+                    self.meaning_words.append(word_id)
+                    self.ru_data.extend(ru)
+                    self.ru_offsets.append(len(self.ru_data))
+                    self.meaning_index[meaning_id] = index
+        return index
+
+    def ru(self, index):
+        return str(self.ru_data[self.ru_offsets[index]:self.ru_offsets[index + 1]])
+
+    def meaning(self, index):
+        return Meaning(
+            self.meaning_ids[index],
+            self.words[self.meaning_words[index]],
+            self.ru(index)
+        )
+
+    def word_mapping(self, word_ids, default=-1):
+        """Returns array mapping every word id to its position in `word_ids`."""
+        mapping = np.empty(self.word_count(), dtype=np.int32)
+        mapping.fill(default)
+        mapping[np.asarray(word_ids, dtype=np.int64)] = np.arange(len(word_ids), dtype=np.int32)
+        return mapping
+
+    def lookup(self, words, mapping, default=-1):
+        """Maps en words through `mapping` created by word_mapping.
+
+        Words unknown to the table or added after the mapping was built
+        get `default`.
+        """
+        res = np.empty(len(words), dtype=mapping.dtype)
+        res.fill(default)
+        for i, word in enumerate(words):
+            word_id = self.word_index.get(word, -1)
+            if 0 <= word_id < len(mapping):
+                res[i] = mapping[word_id]
+        return res
+
+
 class AddedWord(object):
     __slots__ = ['user_id', 'meaning', 'creation_time', 'source']
 
     def __init__(self, user_id, meaning_id, creation_time, source, en, ru):
         self.user_id = user_id
         self.meaning = Meaning(meaning_id, en, ru)
-        self.creation_time = datetime.strptime(creation_time, DATE_FORMAT)
+        self.creation_time = parse_time(creation_time)
         self.source = source
 
     @staticmethod
@@ -105,3 +298,380 @@ class AddedWord(object):
         return str(self)
 
 
+
+
+def parse_lines(lines, source_prefix=None):
+    res = []
+    for line in lines:
+        added_word = AddedWord.parse(line)
+        if not added_word:
+            continue
+        if source_prefix and not added_word.source.startswith(source_prefix):
+            continue
+        res.append(added_word)
+    return res
+
+
+def ordered_map(func, items, workers):
+    """Yields func(*args) for every args tuple of `items`, in order.
+
+    With more than one worker the calls run in a pool of `workers`
+    processes forked on the first item, so they see module globals set
+    before. Only 2 * workers calls are in flight at once, so memory use
+    doesn't depend on the number of items.
+    """
+    pool = Pool(workers) if workers > 1 else None
+    pending = deque()
+    try:
+        items = iter(items)
+        while True:
+            args = next(items, None)
+            if args is not None:
+                if pool:
+                    pending.append(pool.apply_async(func, args))
+                else:
+                    pending.append(func(*args))
+            if not pending:
+                break
+            if args is not None and len(pending) < 2 * workers:
+                continue
+            result = pending.popleft()
+            yield result.get() if pool else result
+    finally:
+        if pool:
+            pool.terminate()
+
+
+def read_added_words(filename, source_prefix=None, workers=None, chunk_bytes=READ_CHUNK_BYTES):
+    """Yields AddedWord items of JSON lines file in file order.
+
+    The file is read in chunks of about `chunk_bytes` which are parsed in
+    a pool of `workers` processes (all cores by default), see ordered_map.
+    """
+    state = {'lines': 0}
+
+    def read_chunks(f):
+        for lines in iter(lambda: f.readlines(chunk_bytes), []):
+            state['lines'] += len(lines)
+            yield lines, source_prefix
+
+    with open(filename, 'r') as f:
+        for chunk in ordered_map(parse_lines, read_chunks(f), workers or cpu_count()):
+            for added_word in chunk:
+                yield added_word
+    log.info('Total %s lines done.' % state['lines'])
+
+
+def group_by_user(added_words):
+    """Yields (user_id, [AddedWord]) for runs of consecutive items of one user."""
+    for user_id, group in it.groupby(added_words, key=lambda x: x.user_id):
+        yield user_id, list(group)
+
+
+def read_user_groups(filename, source_prefix=None, workers=None):
+    return group_by_user(read_added_words(filename, source_prefix, workers))
+
+
+class AddedWordDataset(object):
+    """Columnar, memory-mappable copy of an AddedWord corpus.
+
+    Rows keep the order of the source file. en words are interned into
+    `words` (row -> word_ids), meanings into a table sorted by meaning id
+    with the word id and ru translation of every meaning.
+    """
+    FORMAT = 'added_words'
+    VERSION = 1
+
+    def __init__(self):
+        self.user_ids = np.zeros(0, dtype=np.int32)
+        self.meaning_ids = np.zeros(0, dtype=np.int32)
+        self.word_ids = np.zeros(0, dtype=np.int32)
+        self.times = np.zeros(0, dtype=np.int64)
+        self.sources = np.zeros(0, dtype=np.uint8)
+        self.source_names = []
+        self.words = StringTable.from_strings([])
+        self.table_meaning_ids = np.zeros(0, dtype=np.int32)
+        self.table_word_ids = np.zeros(0, dtype=np.int32)
+        self.table_ru = StringTable.from_strings([])
+
+    @staticmethod
+    def build(added_words):
+        user_ids = array('i')
+        meaning_ids = array('i')
+        word_ids = array('i')
+        times = array('l')
+        sources = array('B')
+        words = []
+        word_index = {}
+        source_index = {}
+        meanings = {}
+
+        for added_word in added_words:
+            meaning = added_word.meaning
+            word_id = word_index.get(meaning.en)
+            if word_id is None:
+                word_id = word_index[meaning.en] = len(words)
+                words.append(meaning.en)
+            if meaning.meaning_id not in meanings:
+                meanings[meaning.meaning_id] = (word_id, meaning.ru)
+            source = source_index.get(added_word.source)
+            if source is None:
+                source = source_index[added_word.source] = len(source_index)
+            user_ids.append(added_word.user_id)
+            meaning_ids.append(meaning.meaning_id)
+            word_ids.append(word_id)
+            times.append(calendar.timegm(added_word.creation_time.timetuple()))
+            sources.append(source)
+
+        self = AddedWordDataset()
+        self.user_ids = np.frombuffer(user_ids, dtype=np.int32)
+        self.meaning_ids = np.frombuffer(meaning_ids, dtype=np.int32)
+        self.word_ids = np.frombuffer(word_ids, dtype=np.int32)
+        self.times = np.frombuffer(times, dtype=np.int_).astype(np.int64)
+        self.sources = np.frombuffer(sources, dtype=np.uint8)
+        self.source_names = sorted(source_index, key=source_index.get)
+        self.words = StringTable.from_strings(words)
+        table = sorted(meanings.iteritems())
+        self.table_meaning_ids = np.array([x[0] for x in table], dtype=np.int32)
+        self.table_word_ids = np.array([x[1][0] for x in table], dtype=np.int32)
+        self.table_ru = StringTable.from_strings([x[1][1] for x in table])
+        log.info('Total %s rows, %s words and %s meanings' % (
+            len(self.user_ids), len(self.words), len(self.table_meaning_ids)))
+        return self
+
+    @staticmethod
+    def is_dataset(path):
+        return os.path.isfile(os.path.join(path, MANIFEST_FILE))
+
+    @staticmethod
+    def load(dirname, mmap_mode='r'):
+        manifest = read_manifest(dirname, AddedWordDataset.FORMAT, AddedWordDataset.VERSION)
+        self = AddedWordDataset()
+        for name in ['user_ids', 'meaning_ids', 'word_ids', 'times', 'sources',
+                     'table_meaning_ids', 'table_word_ids']:
+            setattr(self, name, np.load(os.path.join(dirname, name + '.npy'), mmap_mode=mmap_mode))
+        self.source_names = [x.encode('utf-8') for x in manifest['sources']]
+        self.words = StringTable.load(dirname, 'words', mmap_mode)
+        self.table_ru = StringTable.load(dirname, 'table_ru', mmap_mode)
+        return self
+
+    def save(self, dirname):
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        for name in ['user_ids', 'meaning_ids', 'word_ids', 'times', 'sources',
+                     'table_meaning_ids', 'table_word_ids']:
+            np.save(os.path.join(dirname, name + '.npy'), getattr(self, name))
+        self.words.save(dirname, 'words')
+        self.table_ru.save(dirname, 'table_ru')
+        write_manifest(dirname, {
+            'format': self.FORMAT,
+            'version': self.VERSION,
+            'rows': len(self.user_ids),
+            'sources': self.source_names
+        })
+
+    def __len__(self):
+        return len(self.user_ids)
+
+    def meaning_rows(self, meaning_ids):
+        """Maps meaning ids to positions in the meaning table."""
+        return np.searchsorted(self.table_meaning_ids, meaning_ids)
+
+    def meaning(self, row):
+        index = self.meaning_rows(self.meaning_ids[row])
+        return Meaning(
+            int(self.meaning_ids[row]),
+            self.words[self.word_ids[row]],
+            self.table_ru[index]
+        )
+
+    def source_mask(self, source_prefix):
+        codes = [i for i, x in enumerate(self.source_names) if x.startswith(source_prefix)]
+        return np.in1d(self.sources, codes)
+
+    def iter_users(self, source_prefix=None, order=None):
+        """Yields (user_id, rows) for runs of consecutive rows of one user.
+
+        `order` is an optional row permutation applied before grouping
+        (e.g. np.lexsort((dataset.times, dataset.user_ids))).
+        """
+        rows = np.arange(len(self), dtype=np.int64) if order is None else order
+        if source_prefix:
+            rows = rows[self.source_mask(source_prefix)[rows]]
+        if len(rows) < 1:
+            return
+        user_ids = self.user_ids[rows]
+        bounds = np.concatenate([
+            [0], np.flatnonzero(user_ids[1:] != user_ids[:-1]) + 1, [len(rows)]
+        ])
+        for start, end in zip(bounds[:-1], bounds[1:]):
+            yield int(user_ids[start]), rows[start:end]
+
+
+class UserIndex(object):
+    """Byte offsets of the lines of every user in an AddedWord JSON lines file.
+
+    Lets a few users be read without parsing the whole file. User ids are
+    taken from lines with a regexp, so building it is a single fast scan;
+    the index is saved next to the file and reused while the file keeps
+    its size and modification time.
+    """
+    FORMAT = 'user_index'
+    VERSION = 1
+    USER_ID = re.compile(r'"user_id"\s*:\s*(\d+)')
+
+    def __init__(self, filename, offsets, bounds):
+        self.filename = filename
+        self.offsets = offsets
+        self.bounds = bounds
+
+    @staticmethod
+    def build(filename):
+        offsets = array('l')
+        user_ids = array('l')
+        offset = 0
+        with open(filename, 'rb') as f:
+            for line in f:
+                match = UserIndex.USER_ID.search(line)
+                if match is not None and int(match.group(1)):
+                    offsets.append(offset)
+                    user_ids.append(int(match.group(1)))
+                offset += len(line)
+        user_ids = np.frombuffer(user_ids, dtype=np.int_)
+        order = np.argsort(user_ids, kind='mergesort')
+        user_ids = user_ids[order]
+        bounds = np.concatenate([[0], np.flatnonzero(user_ids[1:] != user_ids[:-1]) + 1, [len(order)]])
+        if len(order) == 0:
+            bounds = np.zeros(1, dtype=np.int64)
+        offsets = np.frombuffer(offsets, dtype=np.int_)[order].astype(np.int64)
+        return UserIndex(filename, offsets, bounds.astype(np.int64))
+
+    @staticmethod
+    def open(filename, index_dir=None):
+        """Loads the saved index of `filename` if it is fresh, builds and saves it otherwise."""
+        index_dir = index_dir or filename + '.users'
+        stamp = file_stamp(filename)
+        try:
+            manifest = read_manifest(index_dir, UserIndex.FORMAT, UserIndex.VERSION)
+            if manifest['file'] == stamp:
+                return UserIndex(
+                    filename,
+                    np.load(os.path.join(index_dir, 'offsets.npy'), mmap_mode='r'),
+                    np.load(os.path.join(index_dir, 'bounds.npy'))
+                )
+        except (IOError, ValueError):
+            pass
+        log.info('Indexing users of %s' % filename)
+        self = UserIndex.build(filename)
+        try:
+            if not os.path.isdir(index_dir):
+                os.makedirs(index_dir)
+            np.save(os.path.join(index_dir, 'offsets.npy'), self.offsets)
+            np.save(os.path.join(index_dir, 'bounds.npy'), self.bounds)
+            write_manifest(index_dir, {'format': UserIndex.FORMAT, 'version': UserIndex.VERSION, 'file': stamp})
+        except (IOError, OSError) as e:
+            log.warning('Failed to save user index to %s: %s' % (index_dir, e))
+        return self
+
+    def __len__(self):
+        return len(self.bounds) - 1
+
+    def read_user(self, index):
+        """Returns AddedWord items of user number `index` in file order."""
+        res = []
+        with open(self.filename, 'rb') as f:
+            for offset in self.offsets[self.bounds[index]:self.bounds[index + 1]]:
+                f.seek(offset)
+                res.append(AddedWord.parse(f.readline()))
+        return res
+
+
+def user_of_line(line):
+    match = UserIndex.USER_ID.search(line)
+    return int(match.group(1)) if match is not None else None
+
+
+def user_shards(filename, shards):
+    """Splits a JSON lines file into at most `shards` (start, end) byte ranges.
+
+    Ranges are of about equal size and start at lines whose user differs
+    from the user of the previous line, so a run of lines of one user is
+    never split between two ranges.
+    """
+    size = os.path.getsize(filename)
+    starts = [0]
+    with open(filename, 'rb') as f:
+        for i in range(1, shards):
+            target = max(size * i // shards, starts[-1] + 1)
+            if target >= size:
+                break
+            f.seek(target - 1)
+            f.readline()
+            user_id = user_of_line(f.readline())
+            while True:
+                offset = f.tell()
+                line = f.readline()
+                if not line or user_of_line(line) != user_id:
+                    break
+            if offset >= size:
+                break
+            starts.append(offset)
+    return zip(starts, starts[1:] + [size])
+
+
+def read_range(filename, start, end, source_prefix=None, chunk_bytes=READ_CHUNK_BYTES):
+    """Yields AddedWord items of lines in [start, end) byte range, see user_shards."""
+    offset = start
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        while offset < end:
+            lines = f.readlines(min(chunk_bytes, end - offset))
+            if not lines:
+                break
+            taken = []
+            for line in lines:
+                if offset >= end:
+                    break
+                taken.append(line)
+                offset += len(line)
+            for added_word in parse_lines(taken, source_prefix):
+                yield added_word
+
+
+def remove_path(path):
+    """Removes a file or a directory tree if it exists."""
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+def replace_dir(dirname, save):
+    """Calls save(path) on a temporary directory and moves it to `dirname`.
+
+    Files of the old directory are never overwritten in place, so readers
+    that memory-mapped them keep working. An old model file (such as a
+    legacy pickle) at `dirname` is replaced the same way.
+    """
+    tmp = dirname.rstrip('/') + '.tmp'
+    old = dirname.rstrip('/') + '.old'
+    for path in [tmp, old]:
+        remove_path(path)
+    try:
+        save(tmp)
+    except BaseException:
+        remove_path(tmp)
+        raise
+    if os.path.lexists(dirname):
+        os.rename(dirname, old)
+    os.rename(tmp, dirname)
+    remove_path(old)
+
+
+def open_dataset(path):
+    """Loads AddedWordDataset directory or builds one from JSON lines file."""
+    if AddedWordDataset.is_dataset(path):
+        log.info('Loading dataset %s' % path)
+        return AddedWordDataset.load(path)
+    log.info('Building dataset from %s' % path)
+    return AddedWordDataset.build(read_added_words(path))
@@ -0,0 +1,168 @@
+from argparse import ArgumentParser
+from multiprocessing import cpu_count
+import numpy as np
+import sys
+import time
+import ujson as json
+import batch_predict
+from batch_predict import DEFAULT_MODELS, DEFAULT_NEURAL_WEIGHTS, fork_safe_workers, load_method
+from common import int_list, log, open_dataset, ordered_map
+
+
+def match_key(method):
+    """glovec knows words only, other methods are matched on meaning ids."""
+    return 'en' if method == 'glovec' else 'meaning_id'
+
+
+def read_cases(dataset, key, min_words, max_users=None):
+    """Splits every validate user with at least `min_words` words into (seeds, actual).
+
+    Seeds are the distinct words of the first half, actual are the keys of
+    the second half without the seed words, which are never predicted.
+    """
+    cases = []
+    for user_id, rows in dataset.iter_users('search_'):
+        if len(rows) < min_words:
+            continue
+        meanings = [dataset.meaning(row) for row in rows]
+        boundary = len(meanings) / 2
+        seeds = []
+        for meaning in meanings[:boundary]:
+            if meaning.en not in seeds:
+                seeds.append(meaning.en)
+        actual = set(getattr(x, key) for x in meanings[boundary:] if x.en not in seeds)
+        if actual:
+            cases.append((seeds, actual))
+        if max_users and len(cases) >= max_users:
+            break
+    return cases
+
+
+def predict_chunk(seeds_arr, count, key):
+    """Returns keys of top `count` non-seed predictions of every seed list and the time taken."""
+    start = time.time()
+    results = batch_predict.predictor.predict_batch(seeds_arr, count + max(len(x) for x in seeds_arr))
+    elapsed = time.time() - start
+    res = []
+    for seeds, predicted in zip(seeds_arr, results):
+        seeds = set(seeds)
+        predicted = sorted(predicted, key=lambda x: x['score'], reverse=True)
+        res.append([getattr(x['word'], key) for x in predicted if x['word'].en not in seeds][:count])
+    return res, elapsed
+
+
+def predict_cases(cases, count, key, workers, chunk_size):
+    """Predicts all cases in chunks over a pool, returns (keys per case, seconds per chunk)."""
+    chunks = [[x[0] for x in cases[i:i + chunk_size]] for i in range(0, len(cases), chunk_size)]
+    predicted = []
+    timings = []
+    for keys, elapsed in ordered_map(predict_chunk, ((chunk, count, key) for chunk in chunks), workers):
+        predicted.extend(keys)
+        timings.append((elapsed, len(keys)))
+    return predicted, timings
+
+
+def relevance(cases, predicted, count):
+    """Returns (users x count) 0/1 matrix of hits by rank and the number of actual keys of every user."""
+    hits = np.zeros((len(cases), count), dtype=np.float64)
+    for i, ((seeds, actual), keys) in enumerate(zip(cases, predicted)):
+        for rank, x in enumerate(keys[:count]):
+            hits[i, rank] = x in actual
+    return hits, np.array([len(x[1]) for x in cases], dtype=np.float64)
+
+
+def ranking_metrics(hits, actual_counts, k):
+    hits = hits[:, :k]
+    ranks = np.arange(1, k + 1, dtype=np.float64)
+    found = hits.cumsum(axis=1)
+    ideal = np.minimum(actual_counts, k)
+    discounts = 1 / np.log2(ranks + 1)
+    ideal_dcg = np.cumsum(discounts)[ideal.astype(np.int64) - 1]
+    return {
+        'precision': float(np.mean(found[:, -1] / k)),
+        'recall': float(np.mean(found[:, -1] / actual_counts)),
+        'map': float(np.mean((hits * found / ranks).sum(axis=1) / ideal)),
+        'ndcg': float(np.mean((hits * discounts).sum(axis=1) / ideal_dcg)),
+    }
+
+
+def percentiles(values):
+    values = np.asarray(values, dtype=np.float64)
+    return dict(('p%s' % q, float(np.percentile(values, q))) for q in [50, 90, 99])
+
+
+def evaluate(cases, key, ks, workers, chunk_size):
+    start = time.time()
+    predicted, timings = predict_cases(cases, max(ks), key, workers, chunk_size)
+    wall = time.time() - start
+    hits, actual_counts = relevance(cases, predicted, max(ks))
+    return {
+        'users': len(cases),
+        'metrics': dict((str(k), ranking_metrics(hits, actual_counts, k)) for k in ks),
+        'chunk_latency_ms': percentiles([1000 * elapsed for elapsed, size in timings]),
+        'user_latency_ms': percentiles([1000 * elapsed / size for elapsed, size in timings]),
+        'users_per_second': len(cases) / wall if wall > 0 else 0.0,
+        'seconds': wall,
+    }
+
+
+def main(args):
+    log.info('Loading %s model...' % args.method)
+    # workers forked by ordered_map share the model loaded here
+    batch_predict.predictor = load_method(args.method, args.model, neural_weights=args.neural_weights)
+    workers = fork_safe_workers(batch_predict.predictor, args.workers)
+
+    log.info('Reading validate pool...')
+    key = match_key(args.method)
+    cases = read_cases(open_dataset(args.validate), key, args.min_words, args.max_users)
+    if not cases:
+        sys.exit('No validate users with at least %s words in %s' % (args.min_words, args.validate))
+    log.info('Evaluating %s users...' % len(cases))
+    report = evaluate(cases, key, sorted(set(args.k)), workers, args.chunk_size)
+    report.update({
+        'method': args.method,
+        'model': args.model or DEFAULT_MODELS[args.method],
+        'validate': args.validate,
+        'match': key,
+        'min_words': args.min_words,
+        'workers': workers,
+        'chunk_size': args.chunk_size,
+    })
+    for k in sorted(args.k):
+        log.info('@%s %s' % (k, ' '.join('%s %.4f' % x for x in sorted(report['metrics'][str(k)].items()))))
+    log.info('%.1f users/s, chunk p50 %.1fms p99 %.1fms' % (
+        report['users_per_second'], report['chunk_latency_ms']['p50'], report['chunk_latency_ms']['p99']))
+
+    out = open(args.output, 'w') if args.output != '-' else sys.stdout
+    out.write(json.dumps(report, indent=2) + '\n')
+    out.flush()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Precision, recall, MAP and NDCG of a predictor on validate users')
+    parser.add_argument('-m', '--method', choices=sorted(DEFAULT_MODELS), required=True)
+    parser.add_argument('-M', '--model', metavar='FILE', help='Model file (default: the one the server loads)')
+    parser.add_argument(
+        '-v',
+        '--validate',
+        default='user_words_validate.json',
+        metavar='FILE',
+        help='Validate file or dataset directory (default: user_words_validate.json)'
+    )
+    parser.add_argument('-o', '--output', default='-', metavar='FILE', help='JSON report (default: stdout)')
+    parser.add_argument('-k', type=int_list, default=[1, 5, 10, 30], help='Comma separated cut-offs')
+    parser.add_argument('--min-words', type=int, default=20, help='Users with fewer words are skipped')
+    parser.add_argument('-u', '--max-users', type=int, help='Evaluate only the first users')
+    parser.add_argument('-w', '--workers', type=int, default=cpu_count())
+    parser.add_argument('-c', '--chunk-size', type=int, default=256, help='Users predicted as one batch')
+    parser.add_argument(
+        '--neural-weights',
+        default=DEFAULT_NEURAL_WEIGHTS,
+        metavar='FILE',
+        help='Weights exported by neural.py --export for a legacy JSON model, used when present'
+    )
+
+    args = parser.parse_args()
+    if min(args.k) < 1:
+        parser.error('-k cut-offs must be at least 1')
+    main(args)
@@ -1,84 +1,364 @@
 from argparse import ArgumentParser
-import nmslib
+import hashlib
 import numpy as np
-from common import log, Meaning
-from collections import defaultdict
+import os
+from common import log, file_stamp, Meaning, MeaningTable, StringTable, read_manifest, top_k, write_manifest
 import re
 import string
 
 
-class GlovePredict(object):
-    def __init__(self, filename):
+INDEX_FORMAT = 'glovec'
+INDEX_VERSION = 2
+HNSW_FILE = 'hnsw.bin'
+QUERY_BLOCK = 256
+BAD_SUFFIXES = ('ing', 'ed')
+STEM_SUFFIXES = ('ing', 'ed', 's')
+BAD_CHARS = re.compile('[0123456789`]')
+BAD_START = re.compile(r'[%s]|\d' % re.escape(string.punctuation), flags=re.U)
+
+
+def file_checksum(filename):
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), ''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.sqrt((vectors * vectors).sum(axis=1))
+    norms[norms == 0] = 1
+    return vectors / norms[:, np.newaxis]
+
+
+def nearest(similarities, k):
+    """Returns (ids, cosine distances) of the k most similar columns of every row."""
+    ids = top_k(similarities, k)
+    rows = np.arange(len(similarities))[:, np.newaxis]
+    return [(x, 1 - y) for x, y in zip(ids, similarities[rows, ids])]
+
+
+class HnswIndex(object):
+    """nmslib HNSW graph over cosine distance.
+
+    Parameters left as None keep nmslib defaults. M and efConstruction
+    are fixed when the graph is built, efSearch can be changed any time.
+    """
+    name = 'hnsw'
+
+    def __init__(self, M=None, efConstruction=None, efSearch=None, post=2, num_threads=4):
+        self.params = {'M': M, 'efConstruction': efConstruction, 'post': post}
+        self.ef_search = efSearch
+        self.num_threads = num_threads
+
+    def build_params(self):
+        return dict((k, v) for k, v in self.params.items() if v is not None)
+
+    def init(self, vectors):
+        import nmslib
         self.index = nmslib.init(method='hnsw', space='cosinesimil')
-        self.words = []
-        self.vec_dict = {}
-        log.info('Reading glovec file')
-        with open(filename, 'r') as f:
-            for i, line in enumerate(f):
-                word, points = line.rstrip().split(' ', 1)
-                self.words.append(word)
-                vec = np.fromstring(points, sep=' ')
-                self.vec_dict[word] = vec
-                self.index.addDataPoint(i, vec)
-        self.index.createIndex({'post': 2}, print_progress=True)
-        log.info('Total %s words' % len(self.words))
+        self.index.addDataPointBatch(vectors)
+
+    def set_ef_search(self, ef_search):
+        self.ef_search = ef_search
+        if ef_search is not None:
+            self.index.setQueryTimeParams({'efSearch': ef_search})
+
+    def build(self, vectors):
+        self.init(vectors)
+        self.index.createIndex(self.build_params(), print_progress=True)
+        self.set_ef_search(self.ef_search)
+
+    def save(self, dirname):
+        self.index.saveIndex(os.path.join(dirname, HNSW_FILE))
+
+    def load(self, dirname, vectors):
+        self.init(vectors)
+        self.index.loadIndex(os.path.join(dirname, HNSW_FILE))
+        self.set_ef_search(self.ef_search)
+
+    def query(self, vectors, k):
+        return self.index.knnQueryBatch(vectors, k=k, num_threads=self.num_threads)
+
+
+class ExactIndex(object):
+    """Brute force cosine search as one matrix product per block of queries."""
+    name = 'exact'
+
+    def build_params(self):
+        return {}
+
+    def build(self, vectors):
+        self.unit = normalize(vectors)
+
+    def save(self, dirname):
+        np.save(os.path.join(dirname, 'unit.npy'), self.unit)
+
+    def load(self, dirname, vectors):
+        self.unit = np.load(os.path.join(dirname, 'unit.npy'), mmap_mode='r')
+
+    def query(self, vectors, k):
+        res = []
+        queries = normalize(vectors)
+        for start in xrange(0, len(queries), QUERY_BLOCK):
+            res.extend(nearest(queries[start:start + QUERY_BLOCK].dot(self.unit.T), k))
+        return res
+
+
+class Int8Index(object):
+    """Scans int8 codes of unit vectors, then reranks `rerank * k` candidates exactly.
+
+    Every dimension is scaled to [-127, 127] separately, so the codes take
+    a quarter of float32 vectors; the float vectors are only read for the
+    reranked rows.
+    """
+    name = 'int8'
+
+    def __init__(self, rerank=4, chunk_size=65536):
+        self.rerank = rerank
+        self.chunk_size = chunk_size
+
+    def build_params(self):
+        return {}
+
+    def build(self, vectors):
+        self.vectors = vectors
+        unit = normalize(vectors)
+        scale = np.abs(unit).max(axis=0) / 127
+        scale[scale == 0] = 1
+        self.scale = scale.astype(np.float32)
+        self.codes = np.round(unit / self.scale).astype(np.int8)
+
+    def save(self, dirname):
+        np.save(os.path.join(dirname, 'codes.npy'), self.codes)
+        np.save(os.path.join(dirname, 'scale.npy'), self.scale)
+
+    def load(self, dirname, vectors):
+        self.vectors = vectors
+        self.codes = np.load(os.path.join(dirname, 'codes.npy'), mmap_mode='r')
+        self.scale = np.load(os.path.join(dirname, 'scale.npy'))
+
+    def query(self, vectors, k):
+        res = []
+        queries = normalize(vectors)
+        candidates = max(k, k * self.rerank)
+        for start in xrange(0, len(queries), QUERY_BLOCK):
+            block = queries[start:start + QUERY_BLOCK]
+            scaled = block * self.scale
+            scores = np.empty((len(block), len(self.codes)), dtype=np.float32)
+            for row in xrange(0, len(self.codes), self.chunk_size):
+                chunk = self.codes[row:row + self.chunk_size].astype(np.float32)
+                scores[:, row:row + len(chunk)] = scaled.dot(chunk.T)
+            for query, (ids, _) in zip(block, nearest(scores, candidates)):
+                ids = np.sort(ids)
+                found, distances = nearest(query[np.newaxis].dot(normalize(self.vectors[ids]).T), k)[0]
+                res.append((ids[found], distances))
+        return res
+
+
+BACKENDS = dict((x.name, x) for x in [HnswIndex, ExactIndex, Int8Index])
+
+
+def make_backend(name, params=None):
+    """Creates an index backend from its name and `KEY=VALUE` parameter strings."""
+    kwargs = {}
+    for param in params or []:
+        key, value = param.split('=', 1)
+        try:
+            kwargs[key] = int(value)
+        except ValueError:
+            kwargs[key] = float(value)
+    return BACKENDS[name](**kwargs)
+
+
+def read_vectors(filename, table):
+    log.info('Reading glovec file')
+    word_ids = []
+    vectors = []
+    with open(filename, 'r') as f:
+        for line in f:
+            word, points = line.rstrip().split(' ', 1)
+            word_ids.append(table.add_word(word))
+            vectors.append(np.fromstring(points, sep=' '))
+    return np.array(word_ids, dtype=np.int32), np.array(vectors, dtype=np.float32)
+
+
+class GlovePredict(object):
+    def __init__(self, filename, table=None, index_dir=None, rebuild=False, backend=None):
+        """Loads vectors and nearest neighbour index prebuilt in `index_dir`.
+
+        The index is built from `filename` and saved when it is missing,
+        was built from a different file (by checksum, computed only when
+        size or mtime changed) or with another backend or build
+        parameters, or `rebuild` is set. `backend` is one of BACKENDS,
+        HNSW with nmslib defaults if not given.
+        """
+        self.table = table or MeaningTable()
+        self.index = backend or HnswIndex()
+        index_dir = index_dir or os.path.splitext(filename)[0] + '.index'
+        stamp = file_stamp(filename)
+        if not rebuild and self.is_fresh(index_dir, filename, stamp):
+            self.load_index(index_dir)
+        else:
+            self.word_ids, self.vectors = read_vectors(filename, self.table)
+            self.build_index()
+            try:
+                self.save_index(index_dir, file_checksum(filename), stamp)
+            except (IOError, OSError) as e:
+                log.warning('Failed to save glovec index to %s: %s' % (index_dir, e))
+        self.row_of_word = self.table.word_mapping(self.word_ids)
+        self.build_filters()
+        log.info('Total %s words' % len(self.word_ids))
+
+    def build_index(self):
+        log.info('Building glovec %s index' % self.index.name)
+        self.index.build(self.vectors)
+
+    def is_fresh(self, index_dir, filename, stamp):
+        """Checks the saved index against `filename`, hashing it only if its size or mtime changed."""
+        try:
+            manifest = read_manifest(index_dir, INDEX_FORMAT, INDEX_VERSION)
+        except (IOError, ValueError):
+            return False
+        if manifest.get('backend') != self.index.name or manifest.get('params') != self.index.build_params():
+            return False
+        if manifest.get('file') == stamp:
+            return True
+        if manifest['checksum'] != file_checksum(filename):
+            return False
+        # same contents, remember the new stamp so the next start doesn't hash again
+        manifest['file'] = stamp
+        try:
+            write_manifest(index_dir, manifest)
+        except (IOError, OSError):
+            pass
+        return True
+
+    def load_index(self, index_dir):
+        log.info('Loading glovec %s index from %s' % (self.index.name, index_dir))
+        self.word_ids = np.array(
+            [self.table.add_word(x) for x in StringTable.load(index_dir, 'words')],
+            dtype=np.int32
+        )
+        self.vectors = np.load(os.path.join(index_dir, 'vectors.npy'), mmap_mode='r')
+        self.index.load(index_dir, self.vectors)
+
+    def save_index(self, index_dir, checksum, stamp):
+        log.info('Saving glovec index to %s' % index_dir)
+        if not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+        StringTable.from_strings([self.table.words[x] for x in self.word_ids]).save(index_dir, 'words')
+        np.save(os.path.join(index_dir, 'vectors.npy'), self.vectors)
+        self.index.save(index_dir)
+        write_manifest(index_dir, {
+            'format': INDEX_FORMAT,
+            'version': INDEX_VERSION,
+            'checksum': checksum,
+            'file': stamp,
+            'backend': self.index.name,
+            'params': self.index.build_params()
+        })
 
     def strip_siffixes(self, word):
-        for suf in ['ing', 'ed', 's']:
+        for suf in STEM_SUFFIXES:
             if not word.endswith(suf):
                 continue
             return word[:-len(suf)]
         return word
 
     def is_bad_word(self, word):
-        if any([word.endswith(suf) for suf in ['ing', 'ed']]):
+        if word.endswith(BAD_SUFFIXES):
             return True
-        if any([ch in word for ch in '0123456789`']):
+        if BAD_CHARS.search(word) is not None:
             return True
-        if re.match('[%s]' % re.escape(string.punctuation), word, flags=re.U) is not None:
-            return True
-        if re.match(r'\d', word, flags=re.U):
+        if BAD_START.match(word) is not None:
             return True
         return False
 
-    def predict(self, seeds, count=30):
-        seeds = set([x for x in seeds])
-        if len(seeds) < 1:
-            return []
-        hypos = defaultdict(lambda: [])
-
-        vectors = np.array([self.vec_dict[seed] for seed in seeds if seed in self.vec_dict])
+    def build_filters(self):
+        """Precomputes per-row filters so `predict` only does array lookups.
 
-        neighbours = self.index.knnQueryBatch(vectors, k=count + len(seeds), num_threads=4)
+        `allowed[row]` is False for words `is_bad_word` rejects, `stems[row]`
+        is an id in `stem_index` of the word with suffixes stripped.
+        """
+        self.stem_index = {}
+        allowed = np.empty(len(self.word_ids), dtype=bool)
+        stems = np.empty(len(self.word_ids), dtype=np.int32)
+        for row, word_id in enumerate(self.word_ids):
+            word = self.table.words[word_id]
+            allowed[row] = not self.is_bad_word(word)
+            stems[row] = self.stem_index.setdefault(self.strip_siffixes(word), len(self.stem_index))
+        self.allowed = allowed
+        self.stems = stems
 
-        for ids, distances in neighbours:
-            for id, distance in zip(ids, distances):
-                hypos[id].append(distance)
+    def reduce_neighbours(self, seeds, neighbours, count):
+        ids = np.concatenate([x[0] for x in neighbours]).astype(np.int64)
+        distances = np.concatenate([x[1] for x in neighbours])
 
-        reduced = []
-        for id, distances in hypos.items():
-            word = self.words[id]
-            if word in seeds:
-                continue
-            if self.strip_siffixes(word) in seeds:
-                continue
-            if self.is_bad_word(word):
-                continue
+        # keep the closest distance of every neighbour found by several seeds
+        order = np.lexsort((distances, ids))
+        ids, distances = ids[order], distances[order]
+        first = np.ones(len(ids), dtype=bool)
+        first[1:] = ids[1:] != ids[:-1]
+        ids, distances = ids[first], distances[first]
 
-            reduced.append((word, min(distances)))
-
-        reduced.sort(key=lambda x: x[1])
+        seed_stems = [self.stem_index[x] for x in seeds if x in self.stem_index]
+        keep = self.allowed[ids]
+        keep &= ~np.in1d(self.word_ids[ids], [self.table.word_index.get(x, -1) for x in seeds])
+        keep &= ~np.in1d(self.stems[ids], seed_stems)
+        ids, distances = ids[keep], distances[keep]
 
+        order = np.argsort(distances, kind='mergesort')[:count]
         res = [{
-            'word': Meaning(0, word, ''),
-            'score': float(score)
-        } for word, score in reduced[:count]
+            'word': Meaning(0, self.table.words[self.word_ids[id]], ''),
+            'score': float(distances[i])
+        } for i, id in zip(order, ids[order])
         ]
 
         return res
 
+    def predict_batch(self, seeds_arr, count=30):
+        """Predicts many seed lists with a single index query for all their seeds."""
+        seeds_arr = [set([x for x in seeds]) for seeds in seeds_arr]
+        rows_arr = [self.table.lookup(list(seeds), self.row_of_word) for seeds in seeds_arr]
+        rows_arr = [x[x >= 0] for x in rows_arr]
+        all_rows = np.concatenate(rows_arr + [np.zeros(0, dtype=np.int32)])
+        if len(all_rows) == 0:
+            return [[] for _ in seeds_arr]
+
+        k = max(count + len(seeds) for seeds, rows in zip(seeds_arr, rows_arr) if len(rows))
+        neighbours = self.index.query(self.vectors[all_rows], k)
+        res = []
+        start = 0
+        for seeds, rows in zip(seeds_arr, rows_arr):
+            if len(rows) == 0:
+                res.append([])
+                continue
+            own_k = count + len(seeds)
+            own = [(ids[:own_k], distances[:own_k]) for ids, distances in neighbours[start:start + len(rows)]]
+            res.append(self.reduce_neighbours(seeds, own, count))
+            start += len(rows)
+        return res
+
+    def predict(self, seeds, count=30):
+        seeds = set([x for x in seeds])
+        if len(seeds) < 1:
+            return []
+
+        rows = self.table.lookup(list(seeds), self.row_of_word)
+        rows = rows[rows >= 0]
+        if len(rows) == 0:
+            return []
+
+        neighbours = self.index.query(self.vectors[rows], count + len(seeds))
+        return self.reduce_neighbours(seeds, neighbours, count)
+
 def main(args):
-    method = GlovePredict(args.glovec)
+    backend = make_backend(args.backend, args.param)
+    method = GlovePredict(args.glovec, index_dir=args.index_dir, rebuild=args.build, backend=backend)
+    if args.build:
+        return
     res = method.predict(['owl', 'sparrow', 'crow'], 30)
     print res
     
@@ -86,6 +366,15 @@ def main(args):
 if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument('-g', '--glovec', metavar='FILE', default='glove.6B.50d.txt')
+    parser.add_argument('-i', '--index-dir', metavar='DIR', help='Prebuilt index (default: <glovec>.index)')
+    parser.add_argument('-b', '--build', action='store_true', help='Build and save index, then exit')
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default='hnsw')
+    parser.add_argument(
+        '--param',
+        action='append',
+        metavar='KEY=VALUE',
+        help='Backend parameter, e.g. M=32, efConstruction=400, efSearch=100 or rerank=8 for int8'
+    )
     
     args = parser.parse_args()
     main(args)
@@ -1,29 +1,282 @@
 from argparse import ArgumentParser
-from collections import defaultdict
-import itertools as it
 import os
 
 os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"
 os.environ["CUDA_VISIBLE_DEVICES"] = "0"
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '2'
 
-from common import AddedWord, log, Meaning
-from keras.models import Sequential, load_model
-from keras.layers import Embedding, Dense, GRU, Dropout
-from bisect import bisect_left
+from common import log, MeaningTable, StringTable, open_dataset, read_manifest, replace_dir, top_k, write_manifest
 import numpy as np
 import ujson as json
 import tempfile
-from base64 import b64encode, b64decode
-import random
+from base64 import b64decode
+from Queue import Queue, Empty
 import signal
-import tensorflow as tf
+import threading
+import time
 
-random.seed = 100500
+MODEL_FORMAT = 'neural'
+MODEL_VERSION = 1
+KERAS_FILE = 'model.h5'
+WEIGHTS_DIR = 'weights'
+MIN_CONTEXT = 5
+SPLIT_SEED = 100500
 
 sigint_pressed = False
 
 
+def minibatches(X, Y, batch_size, rng):
+    """Yields shuffled minibatches of (X, Y), rows of every batch read in file order."""
+    order = rng.permutation(len(X))
+    for start in xrange(0, len(order), batch_size):
+        index = np.sort(order[start:start + batch_size])
+        yield X[index], Y[index]
+
+
+def prefetch(items, size):
+    """Iterates `items` in a background thread, keeping up to `size` items ready."""
+    queue = Queue(size)
+    done = object()
+
+    def worker():
+        try:
+            for item in items:
+                queue.put(item)
+        except Exception as e:
+            queue.put(e)
+        queue.put(done)
+
+    thread = threading.Thread(target=worker)
+    thread.daemon = True
+    thread.start()
+    while True:
+        item = queue.get()
+        if item is done:
+            break
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+ACTIVATIONS = {
+    'linear': lambda x: x,
+    'tanh': np.tanh,
+    'relu': lambda x: np.maximum(x, 0),
+    'sigmoid': lambda x: 1 / (1 + np.exp(-x)),
+    'hard_sigmoid': lambda x: np.clip(0.2 * x + 0.5, 0, 1),
+}
+
+
+def softmax(x):
+    e = np.exp(x - x.max(axis=-1, keepdims=True))
+    return e / e.sum(axis=-1, keepdims=True)
+
+
+def activation(name):
+    if name == 'softmax':
+        return softmax
+    if name not in ACTIVATIONS:
+        raise ValueError('Unsupported activation %s' % name)
+    return ACTIVATIONS[name]
+
+
+class NumpyModel(object):
+    """Inference-only NumPy version of the Embedding -> GRU -> Dense stack.
+
+    Weights and layer configs are exported from the trained Keras model
+    into one .npz file; predict() gives the same outputs as Keras
+    predict() without TensorFlow. Dropout layers are identity at
+    inference time and are skipped.
+    """
+    def __init__(self, layers, weights):
+        self.layers = layers
+        self.weights = weights
+
+    @staticmethod
+    def from_keras(model):
+        layers = []
+        weights = []
+        for layer in model.layers:
+            kind = type(layer).__name__
+            if kind == 'Dropout':
+                continue
+            if kind not in ['Embedding', 'GRU', 'Dense']:
+                raise ValueError('Unsupported layer %s' % kind)
+            config = layer.get_config()
+            if config.get('go_backwards') or config.get('return_sequences'):
+                raise ValueError('Unsupported GRU config')
+            layers.append({
+                'type': kind,
+                'mask_zero': config.get('mask_zero', False),
+                'activation': config.get('activation'),
+                'recurrent_activation': config.get('recurrent_activation'),
+                'reset_after': config.get('reset_after', False)
+            })
+            weights.append([np.asarray(x, dtype=np.float32) for x in layer.get_weights()])
+        return NumpyModel(layers, weights)
+
+    @staticmethod
+    def load(filename):
+        data = np.load(filename)
+        layers = json.loads(str(data['layers']))
+        weights = [
+            [data['layer%s_%s' % (i, k)] for k in xrange(layer['weight_count'])]
+            for i, layer in enumerate(layers)
+        ]
+        return NumpyModel(layers, weights)
+
+    @staticmethod
+    def load_dir(dirname, mmap_mode='r'):
+        with open(os.path.join(dirname, 'layers.json'), 'r') as f:
+            layers = json.loads(f.read())
+        weights = [
+            [
+                np.load(os.path.join(dirname, 'layer%s_%s.npy' % (i, k)), mmap_mode=mmap_mode)
+                for k in xrange(layer['weight_count'])
+            ]
+            for i, layer in enumerate(layers)
+        ]
+        return NumpyModel(layers, weights)
+
+    def save_dir(self, dirname):
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        for i, (layer, weights) in enumerate(zip(self.layers, self.weights)):
+            layer['weight_count'] = len(weights)
+            for k, weight in enumerate(weights):
+                np.save(os.path.join(dirname, 'layer%s_%s.npy' % (i, k)), weight)
+        with open(os.path.join(dirname, 'layers.json'), 'w') as f:
+            f.write(json.dumps(self.layers, indent=4))
+
+    def save(self, filename):
+        arrays = {}
+        for i, (layer, weights) in enumerate(zip(self.layers, self.weights)):
+            layer['weight_count'] = len(weights)
+            for k, weight in enumerate(weights):
+                arrays['layer%s_%s' % (i, k)] = weight
+        np.savez(filename, layers=json.dumps(self.layers), **arrays)
+
+    def gru(self, layer, weights, x, mask):
+        kernel, recurrent_kernel, bias = weights
+        units = recurrent_kernel.shape[0]
+        act = activation(layer['activation'])
+        recurrent_act = activation(layer['recurrent_activation'])
+        reset_after = layer['reset_after']
+        input_bias, recurrent_bias = (bias[0], bias[1]) if reset_after else (bias, None)
+
+        x = x.dot(kernel) + input_bias
+        state = np.zeros((len(x), units), dtype=np.float32)
+        steps = x.shape[1]
+        if mask is not None:
+            # rows are left-aligned, so trailing all-padding steps can be skipped
+            steps = np.flatnonzero(mask.any(axis=0))
+            steps = steps[-1] + 1 if len(steps) else 0
+        for t in xrange(steps):
+            x_z = x[:, t, :units]
+            x_r = x[:, t, units:2 * units]
+            x_h = x[:, t, 2 * units:]
+            if reset_after:
+                recurrent = state.dot(recurrent_kernel) + recurrent_bias
+                z = recurrent_act(x_z + recurrent[:, :units])
+                r = recurrent_act(x_r + recurrent[:, units:2 * units])
+                hh = act(x_h + r * recurrent[:, 2 * units:])
+            else:
+                z = recurrent_act(x_z + state.dot(recurrent_kernel[:, :units]))
+                r = recurrent_act(x_r + state.dot(recurrent_kernel[:, units:2 * units]))
+                hh = act(x_h + (r * state).dot(recurrent_kernel[:, 2 * units:]))
+            new_state = z * state + (1 - z) * hh
+            if mask is not None:
+                new_state = np.where(mask[:, t, np.newaxis], new_state, state)
+            state = new_state
+        return state
+
+    def predict(self, X, batch_size=None):
+        X = np.asarray(X, dtype=np.int64)
+        h = X
+        mask = None
+        for layer, weights in zip(self.layers, self.weights):
+            if layer['type'] == 'Embedding':
+                if layer['mask_zero']:
+                    mask = X != 0
+                h = weights[0][X]
+            elif layer['type'] == 'GRU':
+                h = self.gru(layer, weights, h, mask)
+            else:
+                h = activation(layer['activation'])(h.dot(weights[0]) + weights[1])
+        return h
+
+
+class MicroBatcher(object):
+    """Groups concurrent calls into batches for one background thread.
+
+    submit(item) blocks until process_batch(items) has processed a batch
+    that contains the item. A batch is started by the first waiting item
+    and closed after `max_wait` seconds or `max_batch_size` items.
+    """
+    def __init__(self, process_batch, max_batch_size=32, max_wait=0.005):
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.queue = Queue()
+        self.lock = threading.Lock()
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, item):
+        request = {'item': item, 'done': threading.Event()}
+        with self.lock:
+            if self.stopped:
+                return self.process_batch([item])[0]
+            self.queue.put(request)
+        request['done'].wait()
+        if 'error' in request:
+            raise request['error']
+        return request['result']
+
+    def stop(self):
+        """Ends the thread after the submitted items, later items are processed by the caller."""
+        with self.lock:
+            self.stopped = True
+            self.queue.put(None)
+
+    def next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except Empty:
+                break
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.next_batch()
+            stop = None in batch
+            batch = [x for x in batch if x is not None]
+            if batch:
+                self.process(batch)
+            if stop:
+                break
+
+    def process(self, batch):
+        try:
+            results = self.process_batch([x['item'] for x in batch])
+            for request, result in zip(batch, results):
+                request['result'] = result
+        except Exception as e:
+            log.exception('Batch of %s items failed' % len(batch))
+            for request in batch:
+                request['error'] = e
+        for request in batch:
+            request['done'].set()
+
+
 def on_sigint(signal, frame):
     global sigint_pressed
     sigint_pressed = True
@@ -31,16 +284,24 @@ def on_sigint(signal, frame):
 
 
 class NeuralPredict(object):
-    def __init__(self, min_freq, seq_len):
-        self.vocab = []
-        self.meanings = []
-        self.added_words = []
+    def __init__(self, min_freq, seq_len, table=None):
+        self.table = table or MeaningTable()
+        self.vocab = np.zeros(0, dtype=np.int32)
+        self.token_of_word = np.zeros(0, dtype=np.int32)
+        self.meanings = np.zeros(0, dtype=np.int32)
+        self.dataset = None
         self.min_freq = min_freq
         self.seq_len = seq_len
-        self.graph = tf.get_default_graph()
+        self.graph = None
         self.model = None
+        self.batcher = None
 
     def build_model(self):
+        from keras.models import Sequential
+        from keras.layers import Embedding, Dense, GRU, Dropout
+        import tensorflow as tf
+
+        self.graph = tf.get_default_graph()
         model = Sequential([
             Embedding(
                 input_dim=len(self.vocab) + 1,
@@ -66,218 +327,328 @@ class NeuralPredict(object):
 
     def read_vocabs(self, train_file):
         log.info('Reading vocabs...')
-        words = defaultdict(int)
-        meanings = set()
-        with open(train_file, 'r') as f:
-            for i, line in enumerate(f):
-                if (i + 1) % 1000000 == 0:
-                    log.info('%sM lines done.' % ((i + 1)/1000000))
-                    # break
-                added_word = AddedWord.parse(line)
-                # if not added_word.source.startswith('search_'):
-                #     continue
-                self.added_words.append(added_word)
-                words[added_word.meaning.en] += 1
-                meanings.add(added_word.meaning)
-
-        self.meanings = list(meanings)
-        self.meanings.sort()
-
-        self.vocab = list([x for x in words if words[x] >= self.min_freq])
-        self.vocab.sort()
+        dataset = self.dataset = open_dataset(train_file)
+        word_counts = np.bincount(dataset.word_ids, minlength=len(dataset.words))
+
+        vocab = [dataset.words[i] for i in np.flatnonzero(word_counts >= self.min_freq)]
+        vocab.sort()
+        self.set_vocab(vocab, [
+            (int(meaning_id), dataset.words[word_id], dataset.table_ru[i])
+            for i, (meaning_id, word_id) in enumerate(zip(dataset.table_meaning_ids, dataset.table_word_ids))
+        ])
         log.info('Total %s words and %s meanings' % (len(self.vocab), len(self.meanings)))
 
-    def vocab_index(self, word):
-        index = bisect_left(self.vocab, word)
-        if index < len(self.vocab) and self.vocab[index] == word:
-            return index + 1
-        return 0
-
-    def fill_input_vectors(self, seeds_arr, batch_arr, offset):
-        for i, seeds in enumerate(seeds_arr):
-            batch_arr[offset + i] *= 0
-            seed_num = min([self.seq_len, len(seeds)])
-            for k in xrange(seed_num):
-                seed = seeds[-seed_num + k]
-                batch_arr[offset + i][k] = self.vocab_index(seed)
-
-    def batch_generator(self, batch_size):
+    def set_vocab(self, vocab, meanings):
+        """Registers input tokens and output meanings in the meaning table.
+
+        `vocab` is the list of words for tokens 1..N (0 is padding),
+        `meanings` is the list of (meaning_id, en, ru) in output order.
+        """
+        self.vocab = np.array([self.table.add_word(x) for x in vocab], dtype=np.int32)
+        self.meanings = np.array([self.table.add_meaning(*x) for x in meanings], dtype=np.int32)
+        self.token_of_word = self.table.word_mapping(self.vocab) + 1
+        self.output_of_meaning = dict((self.table.meaning_ids[x], i) for i, x in enumerate(self.meanings))
+        output_words = np.array([self.table.meaning_words[x] for x in self.meanings], dtype=np.int32)
+        self.output_words_order = np.argsort(output_words, kind='mergesort')
+        self.output_words_sorted = output_words[self.output_words_order]
+
+    def encode(self, seeds_arr):
+        """Encodes lists of seed words into (len(seeds_arr), seq_len) int32 token matrix.
+
+        Last seq_len seeds of every list are written from the left,
+        the rest of the row is zero padding.
+        """
+        lengths = np.array([min(self.seq_len, len(x)) for x in seeds_arr], dtype=np.int64)
+        word_index = self.table.word_index
+        word_ids = np.array([
+            word_index.get(seed, -1)
+            for seeds, length in zip(seeds_arr, lengths)
+            for seed in seeds[len(seeds) - length:]
+        ], dtype=np.int64)
+        tokens = np.append(self.token_of_word, 0)
+        word_ids[(word_ids < 0) | (word_ids >= len(self.token_of_word))] = len(self.token_of_word)
+
+        X = np.zeros(shape=(len(seeds_arr), self.seq_len), dtype=np.int32)
+        rows = np.repeat(np.arange(len(seeds_arr)), lengths)
+        cols = np.arange(len(word_ids)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        X[rows, cols] = tokens[word_ids]
+        return X
+
+    def user_samples(self, tokens, labels):
+        """Returns (X, Y) of all (previous seq_len tokens -> next label) samples of one user."""
+        targets = np.arange(MIN_CONTEXT, len(tokens))
+        starts = np.maximum(0, targets - self.seq_len)
+        positions = starts[:, np.newaxis] + np.arange(self.seq_len)[np.newaxis, :]
+        X = np.where(
+            positions < targets[:, np.newaxis],
+            tokens[np.minimum(positions, len(tokens) - 1)],
+            0
+        ).astype(np.int32)
+        return X, labels[targets].astype(np.int32)[:, np.newaxis]
+
+    def dataset_vocab(self, dataset):
+        """Returns dataset word id -> token and dataset meaning row -> output arrays."""
+        tokens = self.table.lookup(list(dataset.words), self.token_of_word, 0)
+        outputs = np.array([self.output_of_meaning[x] for x in dataset.table_meaning_ids], dtype=np.int32)
+        return tokens, outputs
+
+    def build_samples(self, dirname, val_split):
+        """Materializes all training windows into memory-mapped int32 arrays.
+
+        Users are split into train and validation parts once, so samples
+        of one user never end up in both. Returns (train_X, train_Y,
+        val_X, val_Y) opened read-only from `dirname`.
+        """
         log.info('Start building dataset')
         log.info('Sorting added words')
-        self.added_words.sort(key=lambda x: (x.user_id, x.creation_time))
-        epoch = 0
+        dataset = self.dataset
+        order = np.lexsort((dataset.times, dataset.user_ids))
+        tokens, outputs = self.dataset_vocab(dataset)
         log.info('Grouping by user')
-        users = [list(x[1]) for x in it.groupby(self.added_words, key=lambda x: x.user_id)]
-        log.info('Allocating buffers')
-        X = np.ndarray(shape=(batch_size, self.seq_len), dtype=np.int32)
-        Y = np.ndarray(shape=(batch_size, 1), dtype=np.int32)
-        X_pos = 0
-        log.info('Start filling buffers')
-        random.shuffle(users)
-        while True:
-            for added_words in users:
-                words = added_words
-                if len(words) < 6:
-                    continue
-                for i in xrange(5, len(words)):
-                    seeds = [x.meaning.en for x in words[max(0, i - self.seq_len):i]]
-                    self.fill_input_vectors([seeds], X, X_pos)
-                    y_index = bisect_left(self.meanings, words[i].meaning)
-                    assert self.meanings[y_index] == words[i].meaning
-                    Y[X_pos] *= 0
-                    Y[X_pos][0] = y_index
-                    X_pos += 1
-
-                    if X_pos >= len(X):
-                        yield epoch, X, Y
-                        X_pos = 0
-            if X_pos > 0:
-                yield epoch, X[0:X_pos], Y[0:X_pos]
-                X_pos = 0
-
-            epoch += 1
+        users = [rows for user_id, rows in dataset.iter_users(order=order) if len(rows) > MIN_CONTEXT]
+        is_val = np.random.RandomState(SPLIT_SEED).rand(len(users)) < val_split
+        sample_counts = np.array([len(x) - MIN_CONTEXT for x in users], dtype=np.int64)
+
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        arrays = {}
+        for part, mask in [('train', ~is_val), ('val', is_val)]:
+            count = int(sample_counts[mask].sum())
+            arrays[part] = [
+                np.lib.format.open_memmap(
+                    os.path.join(dirname, '%s_X.npy' % part), 'w+', np.int32, (count, self.seq_len)),
+                np.lib.format.open_memmap(
+                    os.path.join(dirname, '%s_Y.npy' % part), 'w+', np.int32, (count, 1)),
+                0
+            ]
+            log.info('Total %s %s samples' % (count, part))
+
+        log.info('Filling samples')
+        for rows, val in zip(users, is_val):
+            buffers = arrays['val' if val else 'train']
+            X, Y, pos = buffers
+            user_X, user_Y = self.user_samples(
+                tokens[dataset.word_ids[rows]],
+                outputs[dataset.meaning_rows(dataset.meaning_ids[rows])]
+            )
+            X[pos:pos + len(user_X)] = user_X
+            Y[pos:pos + len(user_Y)] = user_Y
+            buffers[2] = pos + len(user_X)
+
+        res = []
+        for part in ['train', 'val']:
+            X, Y, pos = arrays[part]
+            X.flush()
+            Y.flush()
+            res.append(np.load(os.path.join(dirname, '%s_X.npy' % part), mmap_mode='r'))
+            res.append(np.load(os.path.join(dirname, '%s_Y.npy' % part), mmap_mode='r'))
+        return res
 
     def train(self, train_file, args):
         self.read_vocabs(train_file)
+        train_X, train_Y, val_X, val_Y = self.build_samples(args.samples, args.val_split)
         if not self.model:
             self.model = self.build_model()
 
         signal.signal(signal.SIGINT, on_sigint)
-        batch_no = 0
-        epoch_train_losses = []
-        epoch_val_losses = []
-        epoch_acc = []
-        epoch_val_acc = []
-        prev_epoch = None
-        for epoch, X, Y in self.batch_generator(args.gen_batch_size):
-            if prev_epoch is not None and prev_epoch != epoch:
-                avg_train = np.average(epoch_train_losses)
-                avg_val = np.average(epoch_val_losses)
-                avg_train_acc = np.average(epoch_acc)
-                avg_val_acc = np.average(epoch_val_acc)
-                log.info('Average epoch losses:')
-                log.info('Train:\t%.6f' % avg_train)
-                log.info('Val:\t%.6f' % avg_val)
-                log.info('Train acc:\t%.6f' % avg_train_acc)
-                log.info('Val acc:\t%.6f' % avg_val_acc)
-                epoch_train_losses = []
-                epoch_val_losses = []
-                epoch_acc = []
-                epoch_val_acc = []
-                batch_no = 0
-
-            prev_epoch = epoch
-
+        rng = np.random.RandomState(SPLIT_SEED)
+        for epoch in xrange(args.epochs):
+            batches = prefetch(minibatches(train_X, train_Y, args.batch_size, rng), args.prefetch)
+            epoch_results = []
+            for batch_no, (X, Y) in enumerate(batches):
+                if sigint_pressed:
+                    break
+                epoch_results.append(self.model.train_on_batch(X, Y))
+                if (batch_no + 1) % args.log_every == 0:
+                    loss, acc = np.average(epoch_results[-args.log_every:], axis=0)
+                    log.info('Epoch #%s, batch #%s: training loss %.6f | acc %.6f' % (
+                        epoch, batch_no, loss, acc))
             if sigint_pressed:
                 log.info('Stop training due to SIGINT catched.')
                 break
-            if epoch >= args.epochs:
-                break
-            history = self.model.fit(
-                X, Y,
-                batch_size=args.batch_size,
-                epochs=1,
-                validation_split=0.2,
-                shuffle=False,
-                verbose=0
-                # initial_epoch=epoch,
-            )
-            if 'loss' in history.history and 'val_loss' in history.history:                
-                log.info('Epoch #%s, batch #%s: training loss %.6f | acc %.6f || val loss %.6f | acc %.6f' % (
-                    epoch,
-                    batch_no,
-                    history.history['loss'][-1],
-                    history.history['acc'][-1],
-                    history.history['val_loss'][-1],
-                    history.history['val_acc'][-1]
-                ))
-                epoch_train_losses.append(history.history['loss'][-1])
-                epoch_val_losses.append(history.history['val_loss'][-1])
-                epoch_acc.append(history.history['acc'][-1])
-                epoch_val_acc.append(history.history['val_acc'][-1])
-            else:
-                log.info(str(history.history.keys()))
-            batch_no += 1
 
+            avg_train, avg_train_acc = np.average(epoch_results, axis=0)
+            log.info('Average epoch losses:')
+            log.info('Train:\t%.6f' % avg_train)
+            log.info('Train acc:\t%.6f' % avg_train_acc)
+            if len(val_X) > 0:
+                avg_val, avg_val_acc = self.model.evaluate(val_X, val_Y, batch_size=args.batch_size, verbose=0)
+                log.info('Val:\t%.6f' % avg_val)
+                log.info('Val acc:\t%.6f' % avg_val_acc)
 
     def save(self, model_filename):
-        self.model.save(model_filename, overwrite=True)
-        with open(model_filename, 'rb') as weights_file:
-            model_dump = weights_file.read()
-        jdata = {
+        """Saves model as a directory: manifest, weights and vocab tables.
+
+        The Keras model file is kept for further training, NumPy weights
+        (one .npy per array) are used for serving.
+        """
+        if not os.path.isdir(model_filename):
+            os.makedirs(model_filename)
+        if isinstance(self.model, NumpyModel):
+            numpy_model = self.model
+        else:
+            self.model.save(os.path.join(model_filename, KERAS_FILE), overwrite=True)
+            numpy_model = NumpyModel.from_keras(self.model)
+        numpy_model.save_dir(os.path.join(model_filename, WEIGHTS_DIR))
+
+        meanings = map(self.table.meaning, self.meanings)
+        StringTable.from_strings([self.table.words[x] for x in self.vocab]).save(model_filename, 'vocab')
+        np.save(
+            os.path.join(model_filename, 'meaning_ids.npy'),
+            np.array([x.meaning_id for x in meanings], dtype=np.int32)
+        )
+        StringTable.from_strings([x.en for x in meanings]).save(model_filename, 'meaning_en')
+        StringTable.from_strings([x.ru for x in meanings]).save(model_filename, 'meaning_ru')
+        write_manifest(model_filename, {
+            'format': MODEL_FORMAT,
+            'version': MODEL_VERSION,
             'seq_len': self.seq_len,
-            'min_freq': self.min_freq,
-            'model': b64encode(model_dump),
-            'vocab': self.vocab,
-            'meanings': [{
-                    'id': x.meaning_id,
-                    'en': x.en,
-                    'ru': x.ru
-                } for x in self.meanings
-            ]
-        }
-        os.remove(model_filename)
-        with open(model_filename, 'w') as f:
-            f.write(json.dumps(jdata, ensure_ascii=False, indent=4))
+            'min_freq': self.min_freq
+        })
 
     @staticmethod
-    def load(filename):
+    def load(filename, table=None, weights=None, keras=False):
+        """Loads model saved by save() or a legacy JSON model.
+
+        NumPy weights are used unless `keras` is set or there are none;
+        for legacy models they can be given as `weights` (see export).
+        """
+        if not os.path.isdir(filename):
+            return NeuralPredict.load_json(filename, table, weights)
+
+        manifest = read_manifest(filename, MODEL_FORMAT, MODEL_VERSION)
+        self = NeuralPredict(manifest['min_freq'], manifest['seq_len'], table)
+        meaning_ids = np.load(os.path.join(filename, 'meaning_ids.npy'), mmap_mode='r')
+        self.set_vocab(
+            StringTable.load(filename, 'vocab'),
+            zip(
+                meaning_ids.tolist(),
+                StringTable.load(filename, 'meaning_en'),
+                StringTable.load(filename, 'meaning_ru')
+            )
+        )
+        weights_dir = os.path.join(filename, WEIGHTS_DIR)
+        if keras or not os.path.isdir(weights_dir):
+            self.load_keras(os.path.join(filename, KERAS_FILE))
+        else:
+            self.model = NumpyModel.load_dir(weights_dir)
+        return self
+
+    @staticmethod
+    def load_json(filename, table=None, weights=None):
+        """Loads model from the legacy base64-in-JSON format."""
         with open(filename, 'r') as f:
             jdata = json.loads(f.read())
-        self = NeuralPredict(jdata['min_freq'], jdata['seq_len'])
-        self.vocab = [x.encode('utf-8') for x in jdata['vocab']]
-        self.meanings = [Meaning(x['id'], x['en'].encode('utf-8'), x['ru'].encode('utf-8')) for x in jdata['meanings']]
-        model_dump = b64decode(jdata['model'])
+        self = NeuralPredict(jdata['min_freq'], jdata['seq_len'], table)
+        self.set_vocab(
+            [x.encode('utf-8') for x in jdata['vocab']],
+            [(x['id'], x['en'].encode('utf-8'), x['ru'].encode('utf-8')) for x in jdata['meanings']]
+        )
+        if weights:
+            self.model = NumpyModel.load(weights)
+            return self
+
+        model_dump = b64decode(jdata.pop('model'))
+        del jdata
         with tempfile.NamedTemporaryFile('wb') as f:
             f.write(model_dump)
             f.flush()
-            self.model = load_model(f.name)
+            del model_dump
+            self.load_keras(f.name)
         return self
 
-    def predict(self, seeds, max_hypos):
-        seed_vec = np.ndarray(shape=(1, self.seq_len))
-        seeds = list(set([x for x in seeds]))
-        self.fill_input_vectors([seeds], seed_vec, 0)
+    def load_keras(self, filename):
+        from keras.models import load_model
+        import tensorflow as tf
+
+        self.graph = tf.get_default_graph()
+        self.model = load_model(filename)
+
+    def export(self, filename):
+        """Saves weights of the Keras model for NumpyModel."""
+        NumpyModel.from_keras(self.model).save(filename)
+
+    def enable_batching(self, max_batch_size, max_wait):
+        """Runs concurrent predict calls as batched forward passes."""
+        self.batcher = MicroBatcher(self.predict_items, max_batch_size, max_wait)
+
+    def predict_outputs(self, X):
+        if self.graph is None:
+            return self.model.predict(X)
         with self.graph.as_default():
-            output = self.model.predict(seed_vec)[0]
-        expect_count = len(seeds) + max_hypos
+            return self.model.predict(X, batch_size=max(1, len(X)))
+
+    def mask_seeds(self, outputs, seeds_arr):
+        """Sets outputs of meanings whose en word is one of the row's seeds to -inf."""
+        word_index = self.table.word_index
+        seed_rows = np.repeat(np.arange(len(seeds_arr)), [len(x) for x in seeds_arr])
+        seed_words = np.array([word_index.get(x, -1) for seeds in seeds_arr for x in seeds], dtype=np.int64)
+        starts = np.searchsorted(self.output_words_sorted, seed_words, 'left')
+        counts = np.searchsorted(self.output_words_sorted, seed_words, 'right') - starts
+        positions = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        outputs[
+            np.repeat(seed_rows, counts),
+            self.output_words_order[np.repeat(starts, counts) + positions]
+        ] = -np.inf
+
+    def predict_batch(self, seeds_arr, max_hypos):
+        seeds_arr = [list(set([x for x in seeds])) for seeds in seeds_arr]
+        outputs = self.predict_outputs(self.encode(seeds_arr))
+        self.mask_seeds(outputs, seeds_arr)
 
-        indexes = np.argpartition(output, -expect_count)[-expect_count:]
-        result_items = list([{'word': self.meanings[i], 'score': output[i]} for i in indexes])
-        result_items.sort(key=lambda x: x['score'], reverse=True)  # sort by score
         res = []
-        for item in result_items:
-            meaning = item['word']
-            score = item['score']
-            if meaning.en in seeds:
-                continue
-            res.append({'word': meaning, 'score': float(score)})
-            if len(res) >= max_hypos:
-                break
+        for row, indexes in zip(outputs, top_k(outputs, int(max_hypos))):
+            res.append([
+                {'word': self.table.meaning(self.meanings[i]), 'score': float(row[i])}
+                for i in indexes if row[i] > -np.inf
+            ])
         return res
 
+    def predict_items(self, items):
+        """Predicts a batch of (seeds, max_hypos) items."""
+        results = self.predict_batch([x[0] for x in items], max([x[1] for x in items]))
+        return [res[:max_hypos] for res, (seeds, max_hypos) in zip(results, items)]
+
+    def predict(self, seeds, max_hypos):
+        if self.batcher:
+            return self.batcher.submit((seeds, max_hypos))
+        return self.predict_batch([seeds], max_hypos)[0]
 
 def main(args):
+    if args.export:
+        log.info('Exporting %s weights to %s...' % (args.model, args.export))
+        NeuralPredict.load(args.model, keras=True).export(args.export)
+        return
+    if args.convert:
+        log.info('Converting %s to %s...' % (args.convert, args.model))
+        replace_dir(args.model, NeuralPredict.load(args.convert).save)
+        return
+
     log.info('Training predict (input: %s)' % args.train)
     if args.preload:
-        model = NeuralPredict.load(args.preload)
+        model = NeuralPredict.load(args.preload, keras=True)
     else:
         model = NeuralPredict(3, 30)
 
     model.train(args.train, args)
     log.info('Saving model to %s...' % args.model)
-    model.save(args.model)
+    replace_dir(args.model, model.save)
 
 
 if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument('-e', '--epochs', default=10, type=int)
     parser.add_argument('-b', '--batch-size', default=1000, type=int)
-    parser.add_argument('-g', '--gen-batch-size', default=10000, type=int, help='Batch size for dataset generator')
     parser.add_argument('-t', '--train', default='user_words_train.json')
+    parser.add_argument('-s', '--samples', default='neural_samples', metavar='DIR', help='Directory for training tensors')
+    parser.add_argument('--val-split', default=0.2, type=float, help='Share of users used for validation')
+    parser.add_argument('--prefetch', default=10, type=int, help='Minibatches prepared ahead of training')
+    parser.add_argument('--log-every', default=100, type=int, metavar='BATCHES')
 
     parser.add_argument('-m', '--model', default='neural.model')
     parser.add_argument('-p', '--preload', help='Preload trained model')
+    parser.add_argument('-c', '--convert', metavar='FILE', help='Convert legacy JSON model to the current format')
+    parser.add_argument('-x', '--export', metavar='FILE', help='Export weights of --model for serving without Keras')
     args = parser.parse_args()
 
     main(args)
@@ -1,6 +1,6 @@
 from argparse import ArgumentParser
 from collab import CollabPredict, Stats
-from common import AddedWord, log
+from common import log, open_dataset
 from neural import NeuralPredict
 
 
@@ -10,27 +10,11 @@ def main(args):
     #CollabPredict.load(args.model)
 
     log.info('Reading validate pool...')
-    validate_users = []
-    prev_user = None
-    with open(args.validate, 'r') as f:
-        meanings = []
-        for line in f:
-            parsed = AddedWord.parse(line)
-            if not parsed or not parsed.source.startswith('search_'):
-                continue
-            meaning = parsed.meaning
-            if prev_user is None:
-                meanings = [meaning]
-                prev_user = parsed.user_id
-                continue
-
-            if parsed.user_id != prev_user:
-                validate_users.append(meanings)
-                prev_user = parsed.user_id
-                meanings = []
-            meanings.append(meaning)
-        if len(meanings) > 0:
-            validate_users.append(meanings)
+    dataset = open_dataset(args.validate)
+    validate_users = [
+        [dataset.meaning(row) for row in rows]
+        for user_id, rows in dataset.iter_users('search_')
+    ]
 
     log.info('Validating...')
     for meanings in validate_users:
@@ -80,7 +64,7 @@ if __name__ == '__main__':
         '--validate',
         default='user_words_validate.json',
         metavar='FILE',
-        help='Validate file (default: user_words_validate.tsv)'
+        help='Validate file or dataset directory (default: user_words_validate.json)'
     )
     parser.add_argument('-c', '--hypos-count', type=int, default=30)
     
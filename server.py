@@ -2,7 +2,9 @@
 
 from argparse import ArgumentParser
 import cherrypy
+from cherrypy._cpwsgi_server import CPWSGIServer
 from cherrypy.lib.static import serve_file
+from cherrypy.process.servers import ServerAdapter
 import os
 os.environ["CUDA_DEVICE_ORDER"] = "PCI_BUS_ID"   # see issue #152
 os.environ["CUDA_VISIBLE_DEVICES"] = ""
@@ -10,88 +12,471 @@ os.environ["CUDA_VISIBLE_DEVICES"] = ""
 import ujson as json
 from collab import CollabPredict, Stats
 import cherrypy_cors
-from neural import NeuralPredict
-from glovec import GlovePredict
-from common import AddedWord
+from neural import NeuralPredict, NumpyModel
+from glovec import BACKENDS, GlovePredict, make_backend
+from common import MeaningTable, UserIndex, prediction_json
 import random
 import itertools as it
+from collections import OrderedDict
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+import signal
+import socket
+import threading
+import time
+
+
+BATCH_CHUNK = 256
+RANDOM_TRIES = 100
+WARM_UP_SEEDS = ['cat', 'dog', 'house']
+
+
+def is_list_of_string_lists(value):
+    return isinstance(value, list) and all(
+        isinstance(x, list) and all(isinstance(y, basestring) for y in x) for x in value
+    )
+
+
+def model_stamp(path):
+    """Returns (mtime, size) of the newest file of a model file or directory."""
+    files = [path]
+    if os.path.isdir(path):
+        files = [os.path.join(root, x) for root, dirs, names in os.walk(path) for x in names]
+    stats = [os.stat(x) for x in files]
+    return max([0] + [x.st_mtime for x in stats]), sum(x.st_size for x in stats)
+
+
+class ResultCache(object):
+    """Thread-safe LRU cache of formatted method predictions with optional TTL.
+
+    Keys carry a per-method generation, `invalidate` bumps it so results
+    of a replaced model, even ones still being computed, are never served.
+    """
+    def __init__(self, max_size=10000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.generations = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def key(self, name, seeds, count):
+        return name, self.generations.get(name, 0), seeds, count
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.pop(key, None)
+            if item is not None and self.ttl is not None and item[0] < time.time() - self.ttl:
+                self.expirations += 1
+                item = None
+            if item is None:
+                self.misses += 1
+                return None
+            self.items[key] = item
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, value):
+        if self.max_size < 1:
+            return
+        with self.lock:
+            if key[1] != self.generations.get(key[0], 0):
+                return
+            self.items.pop(key, None)
+            self.items[key] = (time.time(), value)
+            while len(self.items) > self.max_size:
+                self.items.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, name):
+        with self.lock:
+            self.generations[name] = self.generations.get(name, 0) + 1
+            for key in [x for x in self.items if x[0] == name]:
+                del self.items[key]
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.items),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'generations': dict(self.generations)
+            }
 
 
 class WordPredict(object):
-    def __init__(self, validate_filepath):
-        self.random_users = []
-        self.random_lessons = []
-        cherrypy.log('Reading validate file')
-        with open(validate_filepath, 'r') as f:
-            words = []
-            for line in f:
-                word = AddedWord.parse(line)
-                if word:
-                    words.append(word)
-
-        cherrypy.log('Filling random users')
-        words.sort(key=lambda x: (x.user_id, x.source))
-        for user, added_words in it.groupby(words, key=lambda x: x.user_id):
-            en_words = list(set([w.meaning.en for w in added_words]))
-            if len(en_words) < 3:
+    def __init__(
+        self,
+        validate_filepath,
+        neural_batch_size=1,
+        neural_batch_wait=0.0,
+        neural_weights=None,
+        glovec_backend='hnsw',
+        glovec_params=None,
+        predict_timeout=None,
+        method_timeouts=None,
+        predict_threads=30,
+        cache_size=10000,
+        cache_ttl=None
+    ):
+        self.validate_filepath = validate_filepath
+        self.users = None
+        self.meaning_table = MeaningTable()
+        if neural_weights and not os.path.exists(neural_weights):
+            cherrypy.log('No exported weights %s, loading Keras model' % neural_weights)
+            neural_weights = None
+        # every load gets its own backend, a reload must not touch the index being served;
+        # this one only checks the parameters up front
+        make_backend(glovec_backend, glovec_params)
+        self.neural_batching = (neural_batch_size, neural_batch_wait)
+        self.predict_threads = predict_threads
+        self.methods = [{
+            'name': 'neural',
+            'path': 'neural_w_lessons2.model',
+            'load': lambda path: NeuralPredict.load(path, self.meaning_table, neural_weights),
+        }, {
+            'name': 'collab',
+            'path': 'collab.model',
+            'load': lambda path: CollabPredict.load(path, self.meaning_table),
+        }, {
+            'name': 'glovec',
+            'path': 'glove.6B.50d.txt',
+            'load': lambda path: GlovePredict(
+                path, self.meaning_table, backend=make_backend(glovec_backend, glovec_params)
+            ),
+        }]
+        for obj in self.methods:
+            obj['timeout'] = (method_timeouts or {}).get(obj['name'], predict_timeout)
+            obj['state'] = 'loading'
+            obj['method'] = None
+            obj['version'] = 0
+            obj['reloading'] = False
+        self.pool = None
+        self.cache = ResultCache(cache_size, cache_ttl)
+        self.state_lock = threading.Lock()
+        self.loaders = []
+
+    def load(self):
+        """Loads the validate file index and all methods in background threads."""
+        cherrypy.log('Initializing methods...')
+        self.loaders = [threading.Thread(target=self.load_users)]
+        self.loaders.extend(threading.Thread(target=self.load_method, args=(obj,)) for obj in self.methods)
+        for thread in self.loaders:
+            thread.daemon = True
+            thread.start()
+
+    def wait_loaded(self):
+        for thread in self.loaders:
+            thread.join()
+
+    def load_users(self):
+        try:
+            self.users = UserIndex.open(self.validate_filepath)
+            cherrypy.log('Total %s validate users' % len(self.users))
+        except Exception:
+            cherrypy.log('Failed to index %s' % self.validate_filepath, traceback=True)
+
+    def load_method(self, obj, path=None):
+        """Loads (or reloads) a method and swaps it in once it is warmed up.
+
+        Requests already running keep the model they started with, the
+        batcher of a replaced neural model stops after its queued items.
+        """
+        path = path or obj['path']
+        started = time.time()
+        stamp = None
+        try:
+            stamp = model_stamp(path)
+            method = obj['load'](path)
+            self.warm_up(method)
+        except Exception as e:
+            cherrypy.log('Failed to load %s from %s' % (obj['name'], path), traceback=True)
+            obj['error'] = str(e)
+            # the watcher retries only once the files change again
+            obj['failed_stamp'] = stamp
+            if obj['method'] is None:
+                obj['state'] = 'failed'
+            return False
+        with self.state_lock:
+            if self.pool is not None:
+                self.prepare(obj['name'], method)
+            old = obj['method']
+            obj['method'] = method
+            obj['path'] = path
+            obj['stamp'] = stamp
+            obj['version'] += 1
+            obj['seconds'] = time.time() - started
+            obj['state'] = 'ready'
+            obj.pop('error', None)
+            obj.pop('failed_stamp', None)
+            self.cache.invalidate(obj['name'])
+        if getattr(old, 'batcher', None):
+            old.batcher.stop()
+        cherrypy.log('Loaded %s version %s from %s in %.1fs' % (obj['name'], obj['version'], path, obj['seconds']))
+        return True
+
+    def warm_up(self, method):
+        seeds = WARM_UP_SEEDS
+        if self.users is not None and len(self.users):
+            seeds = [w.meaning.en for w in self.users.read_user(random.randrange(len(self.users)))]
+        for _ in xrange(3):
+            method.predict(seeds, 15)
+
+    def reload_method(self, obj, path=None):
+        """Starts reloading `obj` in a background thread unless it is reloading already."""
+        with self.state_lock:
+            if obj['reloading']:
+                return False
+            obj['reloading'] = True
+        thread = threading.Thread(target=self.run_reload, args=(obj, path))
+        thread.daemon = True
+        thread.start()
+        return True
+
+    def run_reload(self, obj, path):
+        try:
+            self.load_method(obj, path)
+        finally:
+            obj['reloading'] = False
+
+    @staticmethod
+    def is_changed(obj, stamp):
+        """Whether `stamp` differs both from the loaded files and from files that already failed to load."""
+        return stamp != obj['stamp'] and stamp != obj.get('failed_stamp')
+
+    def changed_methods(self):
+        """Returns loaded methods whose model files changed since they were loaded."""
+        res = []
+        for obj in self.methods:
+            if 'stamp' not in obj:
                 continue
-            self.random_users.append(en_words)
+            try:
+                if self.is_changed(obj, model_stamp(obj['path'])):
+                    res.append(obj)
+            except OSError:
+                pass
+        return res
+
+    def reload_changed(self):
+        """Reloads changed methods in this thread, used by the pre-fork parent before restarting workers.
 
-        cherrypy.log('Filling random lessons')
-        for (user, source), added_words in it.groupby(words, key=lambda x: (x.user_id, x.source)):
-            if not source.startswith('lesson_'):
+        Returns whether any of them was reloaded.
+        """
+        return any([self.load_method(obj) for obj in self.changed_methods()])
+
+    def poll_changed(self, polled):
+        """Returns methods whose files differ from the loaded ones but are the same as on the last poll.
+
+        `polled` maps method names to the stamps seen by the last poll and
+        is updated, so files still being written are not reloaded.
+        """
+        res = []
+        for obj in self.methods:
+            if 'stamp' not in obj:
                 continue
-            en_words = list(set([w.meaning.en for w in added_words]))
-            if len(en_words) < 3:
+            try:
+                stamp = model_stamp(obj['path'])
+            except OSError:
+                polled.pop(obj['name'], None)
                 continue
-            self.random_lessons.append(en_words)
-        cherrypy.log('Totas %s users, %s lessons' % (len(self.random_users), len(self.random_lessons)))
+            if self.is_changed(obj, stamp) and polled.get(obj['name']) == stamp:
+                res.append(obj)
+            polled[obj['name']] = stamp
+        return res
 
-        cherrypy.log('Initializing methods...')
+    def watch(self, interval):
+        """Reloads methods whose files changed and then stayed the same for `interval` seconds."""
+        polled = {}
+        while True:
+            time.sleep(interval)
+            for obj in self.poll_changed(polled):
+                self.reload_method(obj)
 
-        self.methods = [{
-            'name': 'neural', 'method': NeuralPredict.load('neural_w_lessons2.model'),
-        }, {
-            'name': 'collab', 'method': CollabPredict.load('collab.model'),
-        },
-            {
-            'name': 'glovec', 'method': GlovePredict('glove.6B.50d.txt'),
+    def start_watching(self, interval):
+        thread = threading.Thread(target=self.watch, args=(interval,))
+        thread.daemon = True
+        thread.start()
+
+    def prepare(self, name, method):
+        if name == 'neural' and self.neural_batching[0] > 1:
+            method.enable_batching(*self.neural_batching)
+
+    def start(self):
+        """Starts prediction threads, in every worker when serving with forked processes."""
+        with self.state_lock:
+            self.pool = ThreadPool(self.predict_threads)
+            for obj in self.methods:
+                if obj['method'] is not None:
+                    self.prepare(obj['name'], obj['method'])
+
+    def ready_methods(self):
+        return [obj for obj in self.methods if obj['state'] == 'ready']
+
+    @cherrypy.expose
+    def ready(self):
+        """Reports load state of every method; responds with 503 until all of them are ready."""
+        res = {
+            'methods': dict(
+                (obj['name'], dict(
+                    (k, obj[k]) for k in ['state', 'path', 'version', 'reloading', 'seconds', 'error'] if k in obj
+                ))
+                for obj in self.methods
+            ),
+            'validate': 'ready' if self.users is not None else 'loading',
         }
-        ]
+        res['ready'] = len(self.ready_methods()) == len(self.methods) and self.users is not None
+        if not res['ready']:
+            cherrypy.response.status = 503
+        return json.dumps(res)
 
     @cherrypy.expose
     def index(self):
         return serve_file('static/index.html')
 
+    def run_method(self, obj, key, seeds, count):
+        words = prediction_json(obj['method'].predict(list(seeds), count))
+        self.cache.put(key, words)
+        return words
+
+    def predict_all(self, seeds, count):
+        """Runs all methods concurrently, each limited by its own timeout.
+
+        Seeds are deduplicated and sorted, so every seed set has one cache
+        entry per method. A method missing its deadline is reported as
+        degraded with no words, its prediction is left to finish in the pool
+        and still fills the cache.
+        """
+        start = time.time()
+        seeds = tuple(sorted(set(seeds)))
+        pending = []
+        for obj in self.ready_methods():
+            key = self.cache.key(obj['name'], seeds, count)
+            words = self.cache.get(key)
+            if words is None:
+                words = self.pool.apply_async(self.run_method, (obj, key, seeds, count))
+            pending.append((obj, words))
+
+        res = []
+        for obj, words in pending:
+            item = {'title': obj['name'], 'words': words}
+            if isinstance(words, list):
+                res.append(item)
+                continue
+            try:
+                if obj['timeout'] is None:
+                    item['words'] = words.get()
+                else:
+                    item['words'] = words.get(max(0, start + obj['timeout'] - time.time()))
+            except TimeoutError:
+                cherrypy.log('%s missed its %.3fs deadline' % (obj['name'], obj['timeout']))
+                item['words'] = []
+                item['degraded'] = True
+            res.append(item)
+        return res
+
     @cherrypy.expose
     def get_predicted_words(self, seeds):
         jdata = [x.encode('utf-8') for x in json.loads(seeds)]
+        return json.dumps(self.predict_all(jdata, 15))
+
+    def run_batch(self, obj, seeds_arr, count):
+        # one model for the whole response even if a reload swaps it meanwhile
+        method = obj['method']
         res = []
-        for obj in self.methods:
-            method_name = obj['name']
-            method = obj['method']
-            res.append({
-                'title': method_name,
-                'words': [
-                    {
-                        'meaning_id': x['word'].meaning_id,
-                        'en': x['word'].en,
-                        'ru': x['word'].ru,
-                        'score': x['score']
-                    } for x in method.predict(jdata, 15)
-                    ]
-            })
-        return json.dumps(res)
+        for start in xrange(0, len(seeds_arr), BATCH_CHUNK):
+            chunk = method.predict_batch(seeds_arr[start:start + BATCH_CHUNK], count)
+            res.extend(prediction_json(x) for x in chunk)
+        return res
+
+    @cherrypy.expose
+    @cherrypy.tools.allow(methods=['POST'])
+    @cherrypy.tools.json_in()
+    def predict_batch(self):
+        """Predicts a JSON body {"seeds": [[seed, ...], ...], "methods": [name, ...], "count": 15}.
+
+        The body must be sent with Content-Type: application/json. All ready
+        methods are used if "methods" is missing. Returns an object mapping
+        every method name to the list of predictions of all seed lists.
+        """
+        request = cherrypy.request.json
+        if not isinstance(request, dict) or not is_list_of_string_lists(request.get('seeds')):
+            raise cherrypy.HTTPError(400, '"seeds" must be a list of lists of words')
+        if not is_list_of_string_lists([request.get('methods') or []]):
+            raise cherrypy.HTTPError(400, '"methods" must be a list of method names')
+        try:
+            count = int(request.get('count', 15))
+        except (TypeError, ValueError):
+            raise cherrypy.HTTPError(400, '"count" must be an integer')
+        seeds_arr = [[x.encode('utf-8') for x in seeds] for seeds in request['seeds']]
+        names = request.get('methods') or [x['name'] for x in self.ready_methods()]
+        unknown = set(names) - set(x['name'] for x in self.methods)
+        if unknown:
+            raise cherrypy.HTTPError(400, 'Unknown methods: %s' % ', '.join(sorted(unknown)))
+        not_ready = set(names) - set(x['name'] for x in self.ready_methods())
+        if not_ready:
+            raise cherrypy.HTTPError(503, 'Methods are not ready: %s' % ', '.join(sorted(not_ready)))
+        pending = [
+            (obj['name'], self.pool.apply_async(self.run_batch, (obj, seeds_arr, count)))
+            for obj in self.ready_methods() if obj['name'] in names
+        ]
+        return json.dumps(dict((name, result.get()) for name, result in pending))
+
+    @cherrypy.expose
+    @cherrypy.tools.allow(methods=['POST'])
+    def reload(self, method, path=None):
+        """Reloads a method (or "all") in the background, optionally from a new `path`.
+
+        Only accepted from localhost. With forked workers this reloads just
+        the worker serving the request, send SIGHUP to the parent instead.
+        """
+        if cherrypy.request.remote.ip not in ('127.0.0.1', '::1'):
+            raise cherrypy.HTTPError(403)
+        objs = [obj for obj in self.methods if method in (obj['name'], 'all')]
+        if not objs:
+            raise cherrypy.HTTPError(400, 'Unknown method: %s' % method)
+        if path and len(objs) > 1:
+            raise cherrypy.HTTPError(400, 'path needs a single method')
+        cherrypy.response.status = 202
+        return json.dumps(dict((obj['name'], self.reload_method(obj, path)) for obj in objs))
+
+    @cherrypy.expose
+    def cache_stats(self):
+        return json.dumps(self.cache.stats())
+
+    def random_words(self, lessons):
+        """Picks at least 3 distinct en words of a random validate user or one of their lessons."""
+        if self.users is None:
+            raise cherrypy.HTTPError(503, 'Validate users are not indexed yet')
+        for _ in xrange(RANDOM_TRIES):
+            added_words = self.users.read_user(random.randrange(len(self.users)))
+            if lessons:
+                added_words.sort(key=lambda x: x.source)
+                groups = [
+                    list(group) for source, group in it.groupby(added_words, key=lambda x: x.source)
+                    if source.startswith('lesson_')
+                ]
+            else:
+                groups = [added_words]
+            groups = [list(set([w.meaning.en for w in group])) for group in groups]
+            groups = [x for x in groups if len(x) >= 3]
+            if groups:
+                return random.choice(groups)
+        raise cherrypy.HTTPError(404, 'No random words found')
 
     @cherrypy.expose
     def random_user(self):
-        words = random.choice(self.random_users)
-        return json.dumps(words)
+        return json.dumps(self.random_words(False))
 
     @cherrypy.expose
     def random_lesson(self):
-        words = random.choice(self.random_lessons)
-        return json.dumps(words)
+        return json.dumps(self.random_words(True))
 
 def CORS():
     cherrypy.response.headers['Access-Control-Allow-Origin'] = 'http://eantonov.name'
@@ -99,12 +484,136 @@ def CORS():
     cherrypy.response.headers['Access-Control-Allow-Methods'] = 'GET, POST'
 
 
+class SharedSocketServer(CPWSGIServer):
+    """CherryPy HTTP server accepting connections on a socket bound by the parent process."""
+    def __init__(self, listener):
+        CPWSGIServer.__init__(self, cherrypy.server)
+        self.listener = listener
+        self.accepting = True
+        self.accept_stopped = threading.Event()
+
+    def bind(self, family, type, proto=0):
+        self.socket = self.listener
+
+    def tick(self):
+        if self.accepting:
+            return CPWSGIServer.tick(self)
+        self.accept_stopped.set()
+        time.sleep(0.1)
+
+    def stop(self):
+        # CherryPy drops connections accepted after it starts stopping; on a
+        # shared socket those are real clients, so stop accepting first
+        self.accepting = False
+        if self.ready:
+            self.accept_stopped.wait(2)
+        CPWSGIServer.stop(self)
+
+
+def run_worker(app, listener):
+    for signum in [signal.SIGHUP, signal.SIGTERM, signal.SIGINT]:
+        signal.signal(signum, signal.SIG_DFL)
+    app.start()
+    cherrypy.config.update({'engine.autoreload.on': False})
+    # the port is taken by the parent, so skip the adapter's free port checks
+    cherrypy.server.unsubscribe()
+    ServerAdapter(cherrypy.engine, SharedSocketServer(listener)).subscribe()
+    cherrypy.tree.mount(app, '/skyeng')
+    cherrypy.engine.signal_handler.handlers.pop('SIGHUP', None)
+    cherrypy.engine.signals.subscribe()
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    cherrypy.engine.start()
+    cherrypy.engine.block()
+
+
+def fork_worker(app, listener):
+    pid = os.fork()
+    if pid:
+        return pid
+    code = 0
+    try:
+        run_worker(app, listener)
+    except BaseException:
+        cherrypy.log('Worker %s failed' % os.getpid(), traceback=True)
+        code = 1
+    os._exit(code)
+
+
+def serve_forked(app, host, port, workers, restart_delay, watch_interval=None):
+    """Serves `app` from `workers` processes forked after the models are loaded.
+
+    Workers accept connections on one socket bound here and share the
+    model pages with the parent copy-on-write. Dead workers are replaced.
+    SIGHUP reloads models whose files changed and restarts workers one
+    generation at a time: new ones are forked, old ones get SIGTERM after
+    `restart_delay` seconds and finish the requests they have. With
+    `watch_interval` changed model files are reloaded the same way, but
+    workers are restarted only if a reload succeeded. SIGTERM or SIGINT
+    stops all of them.
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(socket.SOMAXCONN)
+
+    state = {'restart': False, 'stop': False}
+    signal.signal(signal.SIGHUP, lambda signum, frame: state.update(restart=True))
+    signal.signal(signal.SIGTERM, lambda signum, frame: state.update(stop=True))
+    signal.signal(signal.SIGINT, lambda signum, frame: state.update(stop=True))
+
+    pids = set(fork_worker(app, listener) for _ in xrange(workers))
+    cherrypy.log('Serving on %s:%s with workers %s' % (host, port, sorted(pids)))
+    retiring = {}
+    polled = {}
+    next_watch = time.time() + (watch_interval or 0)
+    while not state['stop']:
+        if watch_interval and next_watch <= time.time():
+            if app.poll_changed(polled) and app.reload_changed():
+                state['restart'] = True
+            next_watch = time.time() + watch_interval
+        if state['restart']:
+            state['restart'] = False
+            app.reload_changed()
+            old = list(pids)
+            pids = set(fork_worker(app, listener) for _ in xrange(workers))
+            cherrypy.log('Restarting workers %s as %s' % (sorted(old), sorted(pids)))
+            retiring.update((pid, time.time() + restart_delay) for pid in old)
+        for pid, deadline in retiring.items():
+            if deadline <= time.time():
+                os.kill(pid, signal.SIGTERM)
+                retiring[pid] = float('inf')
+        try:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+        except OSError:
+            pid = 0
+        if pid in retiring:
+            del retiring[pid]
+        elif pid in pids:
+            cherrypy.log('Worker %s exited with status %s, forking a new one' % (pid, status))
+            pids.remove(pid)
+            pids.add(fork_worker(app, listener))
+        elif not pid:
+            time.sleep(0.5)
+
+    cherrypy.log('Stopping workers %s' % sorted(pids | set(retiring)))
+    for pid in pids | set(retiring):
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+    for pid in pids | set(retiring):
+        try:
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
+
+
 def main(args):
     cherrypy_cors.install()
     cherrypy.tools.CORS = cherrypy.Tool('before_handler', CORS)
 
     cherrypy.config.update({
-        'server.socket_host': '0.0.0.0',
+        'server.socket_host': args.host,
         'server.socket_port': args.port,
         'log.access_file': './access.log',
         'log.error_file': './error.log',
@@ -114,16 +623,108 @@ def main(args):
         'tools.CORS.on': True,
         'cors.expose.on': True
     })
-    cherrypy.quickstart(
-        WordPredict(args.validate),
-        '/skyeng'
+    app = WordPredict(
+        args.validate,
+        args.neural_batch_size,
+        args.neural_batch_wait / 1000.0,
+        args.neural_weights,
+        args.glovec_backend,
+        args.glovec_param,
+        predict_timeout=args.predict_timeout / 1000.0 if args.predict_timeout else None,
+        method_timeouts=dict(
+            (name, float(ms) / 1000) for name, ms in (x.split('=', 1) for x in args.method_timeout or [])
+        ),
+        predict_threads=args.predict_threads,
+        cache_size=args.cache_size,
+        cache_ttl=args.cache_ttl
     )
-    
-    
+    app.load()
+    if args.workers > 1:
+        cherrypy.log('Waiting for models to load before forking workers')
+        app.wait_loaded()
+        neural = app.methods[0]['method']
+        if neural is not None and not isinstance(neural.model, NumpyModel):
+            cherrypy.log('Neural model runs in Keras, which is not fork safe; export NumPy weights with neural.py -x')
+        serve_forked(app, args.host, args.port, args.workers, args.restart_delay, args.watch)
+        return
+    app.start()
+    if args.watch:
+        app.start_watching(args.watch)
+    cherrypy.quickstart(app, '/skyeng')
+
+
 if __name__ == '__main__':
     parser = ArgumentParser()
     parser.add_argument('-p', '--port', type=int, default=50000)
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument(
+        '-w',
+        '--workers',
+        type=int,
+        default=1,
+        help='Processes forked after loading models to serve requests (1 serves in this process)'
+    )
+    parser.add_argument(
+        '--restart-delay',
+        type=float,
+        default=5.0,
+        metavar='SECONDS',
+        help='On SIGHUP, time new workers get to start before old ones are stopped'
+    )
+    parser.add_argument(
+        '--watch',
+        type=float,
+        metavar='SECONDS',
+        help='Poll model files this often and reload the ones that changed'
+    )
     parser.add_argument('-v', '--validate', default='user_words_validate.json')
+    parser.add_argument(
+        '--neural-weights',
+        default='neural_w_lessons2.npz',
+        metavar='FILE',
+        help='Weights exported by neural.py --export for a legacy JSON model, used when present'
+    )
+    parser.add_argument(
+        '--neural-batch-size',
+        type=int,
+        default=32,
+        help='Max concurrent neural requests run as one batch (1 disables batching)'
+    )
+    parser.add_argument(
+        '--neural-batch-wait',
+        type=float,
+        default=5.0,
+        metavar='MS',
+        help='Max time to wait for a neural batch to fill'
+    )
+    parser.add_argument('--glovec-backend', choices=sorted(BACKENDS), default='hnsw')
+    parser.add_argument(
+        '--glovec-param',
+        action='append',
+        metavar='KEY=VALUE',
+        help='glovec index backend parameter, see glovec.py --param'
+    )
+    parser.add_argument(
+        '--predict-timeout',
+        type=float,
+        default=1000.0,
+        metavar='MS',
+        help='Time each method has to answer before it is left out of the response (0 waits forever)'
+    )
+    parser.add_argument(
+        '--method-timeout',
+        action='append',
+        metavar='NAME=MS',
+        help='Timeout for a single method, e.g. neural=300'
+    )
+    parser.add_argument(
+        '--predict-threads',
+        type=int,
+        default=30,
+        help='Threads running method predictions for all requests'
+    )
+    parser.add_argument('--cache-size', type=int, default=10000, help='Cached results per server (0 disables)')
+    parser.add_argument('--cache-ttl', type=float, metavar='SECONDS', help='Drop cached results older than this')
     
     args = parser.parse_args()
     main(args)
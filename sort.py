@@ -1,21 +1,76 @@
 from argparse import ArgumentParser
+import cPickle
+import heapq
+import itertools as it
 import sys
-from common import AddedWord
+import tempfile
+from common import AddedWord, DATE_FORMAT
+
+
+def read_runs(lines, run_size):
+    """Yields runs of at most `run_size` input lines, sorted by (user_id, creation_time)."""
+    while True:
+        lines_run = list(it.islice(lines, run_size))
+        if not lines_run:
+            break
+        items = [AddedWord.parse(x.rstrip()) for x in lines_run]
+        items = [x for x in items if x and x.validate()]
+        items.sort(key=lambda x: (x.user_id, x.creation_time))
+        yield [(x.user_id, x.creation_time.strftime(DATE_FORMAT), str(x)) for x in items]
+
+
+def spill(run, temp_dir):
+    f = tempfile.TemporaryFile(dir=temp_dir)
+    pickler = cPickle.Pickler(f, -1)
+    for item in run:
+        pickler.dump(item)
+        pickler.clear_memo()
+    f.seek(0)
+    return f
+
+
+def read_spilled(f, run_no):
+    unpickler = cPickle.Unpickler(f)
+    while True:
+        try:
+            user_id, creation_time, line = unpickler.load()
+        except EOFError:
+            break
+        # run_no keeps the merge stable for equal keys
+        yield user_id, creation_time, run_no, line
 
 
 def main(args):
-    lines = [x.rstrip() for x in sys.stdin]
-    items = [AddedWord.parse(x) for x in lines]
-    items = [x for x in items if x and x.validate()]
-    items.sort(key=lambda x: (x.user_id, x.creation_time))
+    runs = read_runs(sys.stdin, args.run_size)
+    first = next(runs, [])
+    second = next(runs, None)
+    if second is None:
+        for user_id, creation_time, line in first:
+            print line
+        return
+
+    files = []
+    try:
+        for run in it.chain([first, second], runs):
+            files.append(spill(run, args.temp_dir))
+        merged = heapq.merge(*[read_spilled(f, i) for i, f in enumerate(files)])
+        for user_id, creation_time, run_no, line in merged:
+            print line
+    finally:
+        for f in files:
+            f.close()
 
-    for item in items:
-        print item
 
-    
 if __name__ == '__main__':
     parser = ArgumentParser()
+    parser.add_argument(
+        '-r',
+        '--run-size',
+        type=int,
+        default=1000000,
+        help='Lines sorted in memory at once; bigger inputs are merged from temp files'
+    )
+    parser.add_argument('-T', '--temp-dir', metavar='DIR', help='Directory for sorted runs')
 
-    
     args = parser.parse_args()
     main(args)
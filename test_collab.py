@@ -0,0 +1,34 @@
+import unittest
+import numpy as np
+from scipy import sparse
+from collab import CollabPredict
+
+
+class PredictTest(unittest.TestCase):
+    def make_predict(self):
+        # a co-occurs with b exactly as often as chance, so its PMI score is 0
+        predict = CollabPredict(None)
+        predict.set_vocab(['a', 'b', 'c', 'd'], [1, 2, 3, 4], [0, 1, 2, 3], ['ru_a', 'ru_b', 'ru_c', 'ru_d'])
+        predict.word_counts = np.array([40, 50, 20, 25], dtype=np.int32)
+        predict.total_users = 100
+        predict.pairs = sparse.csr_matrix(
+            (np.array([20, 20, 5], dtype=np.int32), (np.array([0, 0, 0]), np.array([1, 2, 3]))),
+            shape=(4, 4)
+        )
+        predict.build_scores()
+        return predict
+
+    def test_zero_score_is_predicted(self):
+        predict = self.make_predict()
+        res = predict.predict(['a'], 15)
+        self.assertEqual([x['word'].meaning_id for x in res], [3, 2, 4])
+        self.assertEqual(res[1]['score'], 0.0)
+
+    def test_predict_batch_matches_predict(self):
+        predict = self.make_predict()
+        seeds_arr = [['a'], ['a', 'b'], ['b'], ['x'], []]
+        self.assertEqual(predict.predict_batch(seeds_arr, 15), [predict.predict(x, 15) for x in seeds_arr])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,99 @@
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from neural import NumpyModel
+
+try:
+    import keras
+except ImportError:
+    keras = None
+
+
+def padded_tokens(rng, rows, seq_len, vocab_size):
+    """Random token rows written from the left with zero padding, as NeuralPredict.encode does."""
+    X = np.zeros((rows, seq_len), dtype=np.int32)
+    for i, length in enumerate(rng.randint(0, seq_len + 1, size=rows)):
+        X[i, :length] = rng.randint(1, vocab_size, size=length)
+    return X
+
+
+def random_model(rng, vocab_size=20, dims=8, units=6, outputs=9, reset_after=False):
+    bias = rng.uniform(-1, 1, (2, 3 * units) if reset_after else 3 * units).astype(np.float32)
+    return NumpyModel(
+        [
+            {'type': 'Embedding', 'mask_zero': True},
+            {'type': 'GRU', 'activation': 'tanh', 'recurrent_activation': 'hard_sigmoid', 'reset_after': reset_after},
+            {'type': 'Dense', 'activation': 'softmax'},
+        ],
+        [
+            [rng.uniform(-1, 1, (vocab_size, dims)).astype(np.float32)],
+            [
+                rng.uniform(-1, 1, (dims, 3 * units)).astype(np.float32),
+                rng.uniform(-1, 1, (units, 3 * units)).astype(np.float32),
+                bias
+            ],
+            [rng.uniform(-1, 1, (units, outputs)).astype(np.float32), rng.uniform(-1, 1, outputs).astype(np.float32)],
+        ]
+    )
+
+
+class NumpyModelTest(unittest.TestCase):
+    def test_padding_is_masked(self):
+        rng = np.random.RandomState(1)
+        for reset_after in [False, True]:
+            model = random_model(rng, reset_after=reset_after)
+            X = padded_tokens(rng, 50, 5, 20)
+            outputs = model.predict(X)
+            for row, output in zip(X, outputs):
+                length = np.count_nonzero(row)
+                if length:
+                    np.testing.assert_allclose(model.predict(row[np.newaxis, :length])[0], output, atol=1e-6)
+
+    def test_save_dir(self):
+        rng = np.random.RandomState(2)
+        model = random_model(rng)
+        dirname = tempfile.mkdtemp()
+        try:
+            model.save_dir(dirname)
+            X = padded_tokens(rng, 20, 5, 20)
+            np.testing.assert_array_equal(NumpyModel.load_dir(dirname).predict(X), model.predict(X))
+        finally:
+            shutil.rmtree(dirname)
+
+
+@unittest.skipIf(keras is None, 'keras is not installed')
+class KerasParityTest(unittest.TestCase):
+    def build_keras(self, **gru_args):
+        from keras.models import Sequential
+        from keras.layers import Dense, Dropout, Embedding, GRU
+        model = Sequential([
+            Embedding(input_dim=20, output_dim=8, input_length=5, mask_zero=True),
+            Dropout(0.2),
+            GRU(6, activation='tanh', **gru_args),
+            Dropout(0.2),
+            Dense(7, activation='tanh'),
+            Dense(9, activation='softmax')
+        ])
+        rng = np.random.RandomState(3)
+        model.set_weights([rng.uniform(-1, 1, x.shape) for x in model.get_weights()])
+        return model
+
+    def check_parity(self, model):
+        X = padded_tokens(np.random.RandomState(4), 100, 5, 20)
+        expected = model.predict(X, batch_size=32)
+        np.testing.assert_allclose(NumpyModel.from_keras(model).predict(X), expected, atol=1e-5)
+
+    def test_gru(self):
+        self.check_parity(self.build_keras())
+
+    def test_gru_reset_after(self):
+        try:
+            model = self.build_keras(reset_after=True, recurrent_activation='sigmoid')
+        except TypeError:
+            self.skipTest('GRU of this keras version has no reset_after')
+        self.check_parity(model)
+
+
+if __name__ == '__main__':
+    unittest.main()